@@ -0,0 +1,150 @@
+"""Generates synthetic sites for benchmarking.
+
+    python benchmarks/generate.py --pages 1000 --depth 3 /tmp/site
+"""
+import json
+import os
+import os.path as osp
+import random
+
+from optparse import OptionParser
+
+DEFAULTS = {
+    'pages': 100,
+    'depth': 2,
+    'fanout': 4,
+    'data_ratio': 1.0,
+    'global_keys': 100,
+    'layout_depth': 2,
+    'static_files': 20,
+    'static_size': 64 * 1024,
+    'seed': 0,
+}
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+         'eiusmod tempor incididunt ut labore et dolore magna aliqua').split()
+
+STATIC_EXTS = ['.css', '.js', '.png', '.txt']
+
+
+def words(rng, n):
+    return ' '.join(rng.choice(WORDS) for _ in range(n))
+
+
+def write(path, data):
+    d = osp.dirname(path)
+    if not osp.exists(d):
+        os.makedirs(d)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def page_dirs(depth, fanout):
+    """Returns the relative directories pages are spread over"""
+    dirs = ['']
+    level = ['']
+    for i in range(depth):
+        level = [osp.join(d, 'd%d' % j) for d in level for j in range(fanout)]
+        dirs.extend(level)
+    return dirs
+
+
+def generate_site(root, pages=100, depth=2, fanout=4, data_ratio=1.0,
+                  global_keys=100, layout_depth=2, static_files=20,
+                  static_size=64 * 1024, seed=0):
+    """Writes a site to `root`: a Stationary config, `layout_depth`
+    layouts each extending the previous one, `pages` pages spread over
+    directories `depth` levels deep, per-page data for `data_ratio` of
+    them, a `_global.json` with `global_keys` keys and `static_files`
+    assets of about `static_size` bytes.
+    """
+    rng = random.Random(seed)
+
+    write(osp.join(root, 'Stationary'), '\n'.join([
+        '[stationary]',
+        'build_directory = build/root',
+        'build_data_directory = build/data',
+        'cache_directory = build/cache',
+        'data_directory = data',
+        'layout_directory = layout',
+        'layout = default',
+        'src_directory = src',
+        '']))
+
+    layout = osp.join(root, 'layout', 'default')
+    write(osp.join(layout, 'layout0.html'),
+          '<html><head><title>{{ site_title }}</title></head>\n'
+          '<body>{% block content %}{% endblock %}</body></html>\n')
+    for i in range(1, layout_depth):
+        write(osp.join(layout, 'layout%d.html' % i),
+              '{%% extends "layout%d.html" %%}\n'
+              '{%% block content %%}<div class="l%d">{%% block inner %%}'
+              '{%% endblock %%}</div>{%% endblock %%}\n' % (i - 1, i))
+    base = 'layout%d.html' % (layout_depth - 1)
+    block = 'inner' if layout_depth > 1 else 'content'
+
+    global_ctx = dict(('key%d' % i, words(rng, 8)) for i in range(global_keys))
+    global_ctx['site_title'] = 'Benchmark site'
+    write(osp.join(root, 'data', '_global.json'), json.dumps(global_ctx))
+
+    dirs = page_dirs(depth, fanout)
+    for i in range(pages):
+        rel = osp.join(dirs[i % len(dirs)], 'page%d.html' % i)
+        write(osp.join(root, 'src', rel),
+              '{%% extends "%s" %%}\n'
+              '{%% block %s %%}\n'
+              '<h1>{{ title }}</h1>\n'
+              '{%% for p in paragraphs %%}{{ p|markdown }}{%% endfor %%}\n'
+              '{%% endblock %%}\n' % (base, block))
+        if rng.random() < data_ratio:
+            write(osp.join(root, 'data', rel[:-len('.html')] + '.json'),
+                  json.dumps({'title': 'Page %d' % i,
+                              'paragraphs': [words(rng, 40)
+                                             for _ in range(5)]}))
+
+    for i in range(static_files):
+        ext = STATIC_EXTS[i % len(STATIC_EXTS)]
+        rel = osp.join(dirs[i % len(dirs)], 'static%d%s' % (i, ext))
+        if ext == '.png':
+            data = os.urandom(static_size)
+        else:
+            data = (words(rng, static_size // 6) + '\n')[:static_size]
+        write(osp.join(root, 'src', rel), data)
+
+
+def add_options(parser):
+    parser.add_option('--pages', type='int', default=DEFAULTS['pages'])
+    parser.add_option('--depth', type='int', default=DEFAULTS['depth'],
+                      help="directory nesting depth")
+    parser.add_option('--fanout', type='int', default=DEFAULTS['fanout'],
+                      help="subdirectories per directory")
+    parser.add_option('--data-ratio', type='float', dest='data_ratio',
+                      default=DEFAULTS['data_ratio'],
+                      help="fraction of pages with a data file")
+    parser.add_option('--global-keys', type='int', dest='global_keys',
+                      default=DEFAULTS['global_keys'])
+    parser.add_option('--layout-depth', type='int', dest='layout_depth',
+                      default=DEFAULTS['layout_depth'],
+                      help="levels of layout inheritance")
+    parser.add_option('--static-files', type='int', dest='static_files',
+                      default=DEFAULTS['static_files'])
+    parser.add_option('--static-size', type='int', dest='static_size',
+                      default=DEFAULTS['static_size'])
+    parser.add_option('--seed', type='int', default=DEFAULTS['seed'])
+
+
+def site_params(options):
+    return dict((k, getattr(options, k)) for k in DEFAULTS)
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] DIRECTORY")
+    add_options(parser)
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("expected a directory to generate the site in")
+    generate_site(args[0], **site_params(options))
+
+
+if __name__ == '__main__':
+    main()
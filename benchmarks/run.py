@@ -0,0 +1,169 @@
+"""Times builds of a synthetic site and writes the results as JSON.
+
+    python benchmarks/run.py --pages 1000 -o results.json
+
+Scenarios: a cold build, a warm build with nothing changed, a build
+after touching one page, develop server request latency (with outputs on
+disk and in memory), and clean.
+"""
+import json
+import logging
+import os
+import os.path as osp
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+
+from optparse import OptionParser
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+
+from stationary import action, server
+from stationary.config import read_config, parser as config_parser
+from stationary.version import __version__
+
+from generate import add_options, generate_site, site_params
+
+
+def timed(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+def load_config(root, jobs):
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        config = read_config()
+    finally:
+        os.chdir(cwd)
+    config.options = config_parser.get_default_values()
+    config.options.jobs = jobs
+    return config
+
+
+def develop_latency(config, paths, repeat):
+    """Returns (first, repeat) request latencies, in seconds, for `paths`
+    served by the develop server
+    """
+    class QuietHandler(server.make_handler(config)):
+        def log_message(self, *args):
+            pass
+
+    httpd = server.PooledHTTPServer(('127.0.0.1', 0), QuietHandler,
+                                    config.server_workers)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    base = 'http://127.0.0.1:%d/' % httpd.server_address[1]
+
+    def fetch(path):
+        start = time.time()
+        urllib2.urlopen(base + path).read()
+        return time.time() - start
+
+    try:
+        first = [fetch(p) for p in paths]
+        again = [fetch(p) for _ in range(repeat) for p in paths]
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+    return first, again
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        'count': len(samples),
+        'mean': sum(samples) / len(samples),
+        'median': samples[len(samples) // 2],
+        'max': samples[-1],
+    }
+
+
+def run(root, jobs=1, requests=20, repeat=5):
+    config = load_config(root, jobs)
+    src_dir = osp.abspath(config.src_directory)
+    pages = sorted(osp.relpath(osp.join(r, f), src_dir)
+                   for r, _, files in os.walk(src_dir)
+                   for f in files if f.endswith('.html'))
+
+    results = {}
+    results['build_cold'] = timed(action.build, config)
+
+    config = load_config(root, jobs)
+    results['build_warm'] = timed(action.build, config)
+
+    with open(osp.join(src_dir, pages[0]), 'a') as f:
+        f.write('\n')
+    config = load_config(root, jobs)
+    results['build_touch_one'] = timed(action.build, config)
+
+    # a fresh build directory, so every first request has to build
+    config = load_config(root, jobs)
+    action.clean(config)
+    first, again = develop_latency(config, pages[:requests], repeat)
+    results['develop_first_request'] = summarize(first)
+    results['develop_repeat_request'] = summarize(again)
+
+    config = load_config(root, jobs)
+    config.develop_output = 'memory'
+    first, again = develop_latency(config, pages[:requests], repeat)
+    results['develop_memory_first_request'] = summarize(first)
+    results['develop_memory_repeat_request'] = summarize(again)
+
+    action.build(load_config(root, jobs))
+    results['clean'] = timed(action.clean, load_config(root, jobs))
+    return results
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    add_options(parser)
+    parser.add_option('-j', '--jobs', type='int', default=1)
+    parser.add_option('--requests', type='int', default=20,
+                      help="pages to request from the develop server")
+    parser.add_option('--repeat', type='int', default=5,
+                      help="times to repeat each develop request")
+    parser.add_option('--site', default=None,
+                      help="directory to generate the site in; a "
+                           "temporary directory by default, removed after")
+    parser.add_option('-o', '--output', default=None,
+                      help="file to write results to (default: stdout)")
+    options, args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    params = site_params(options)
+    root = options.site or tempfile.mkdtemp(prefix='stationary-bench-')
+    try:
+        generate_site(root, **params)
+        results = run(root, options.jobs, options.requests, options.repeat)
+    finally:
+        if not options.site:
+            shutil.rmtree(root, ignore_errors=True)
+
+    report = {
+        'stationary_version': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'jobs': options.jobs,
+        'site': params,
+        'results': results,
+    }
+    out = open(options.output, 'w') if options.output else sys.stdout
+    try:
+        json.dump(report, out, indent=2, sort_keys=True)
+        out.write('\n')
+    finally:
+        if options.output:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,42 +1,38 @@
-import datetime
-import json
+import fnmatch
+import glob
 import logging
-import mimetypes
 import os
 import os.path as osp
-import re
-import urlparse
 import time
 import traceback
-import sys
-import BaseHTTPServer
+import multiprocessing
 
-from functools import wraps
-from xml.sax.saxutils import escape as xmlescape
-from xml.sax.saxutils import quoteattr as xmlquoteattr
+from itertools import izip
 
-from jinja2 import Environment, FileSystemLoader
-
-from utils import reroot
-from build import build_file, build_data
+from utils import reroot, parse_shard, in_shard, shard_filename
+from build import build_file, build_data, compiler_pool
+from config import Config, context_candidates
+from deps import DependencyGraph, DEPS_FILENAME, dependency_graph, page_name
+from events import STARTED, FINISHED, SKIPPED, FAILED, build_events
+from assets import compress_outputs, derived_outputs, fingerprint_assets
+from index import TreeIndex
+from manifest import (Manifest, MANIFEST_FILENAME, manifest_path, file_inputs,
+                      settings_digest)
+from plugins import TASKS_GROUP, entry_points, load_plugin
+import timing
 
 
 TASKS = {}
-BIND_HOST = 'localhost'
-BIND_PORT = 1432
-
-mimetypes.add_type('.coffee', 'text/x-coffeescript')
-mimetypes.add_type('.iced', 'text/x-iced-coffeescript')
-mimetypes.add_type('.less', 'text/css')
-
 
-def task(priority=100):
-    """Registers task
+def task(priority=100, name=None):
+    """Registers task, under `name` if given, otherwise the function's
+    name
     """
     def decorator(func):
-        TASKS[func.__name__] = {
+        task_name = name or func.__name__
+        TASKS[task_name] = {
             'help': func.__doc__,
-            'name': func.__name__,
+            'name': task_name,
             'priority': priority,
             'command': func
             }
@@ -45,105 +41,628 @@ def task(priority=100):
     return decorator
 
 
-def mimeof(path):
-    t, _ = mimetypes.guess_type(path)
-    if t:
-        return t
-    return 'application/octet-stream'
+def find_task(name):
+    """Returns the task called `name`, or None. Tasks provided by other
+    packages, as `stationary.tasks` entry points, are imported and
+    registered the first time they're asked for.
+    """
+    t = TASKS.get(name)
+    if t is None:
+        func = load_plugin(TASKS_GROUP, name)
+        if func is not None:
+            # the plugin may have registered itself with @task
+            if name not in TASKS:
+                task(name=name)(func)
+            t = TASKS[name]
+    return t
+
+
+def build_source(config, src_file):
+    """Builds `src_file`, and its data file if it's a page. Returns
+    the paths of everything that was built.
+    """
+    outputs = [build_file(config, src_file, config.paths.build(src_file))]
 
+    if src_file.endswith('.html'):
+        dest_data_file = build_data(config, src_file,
+                                    config.paths.build_data(src_file))
+        if dest_data_file:
+            outputs.append(dest_data_file)
+    return outputs
 
-def make_handler(config):
-    class BuildHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
-        def do_HEAD(s):
-            s.send_response(200)
-            s.send_header("Content-type", "text/html")
-            s.end_headers()
-    
-        def do_GET(self):
-            """Build/cache and serve a page"""
-            src_dir = osp.abspath(config.src_directory)
-            build_dir = osp.abspath(config.build_directory)
+def output_bytes(config, outputs):
+    """Returns the total size of `outputs`"""
+    return sum(config.output.size(o) or 0 for o in outputs)
 
+
+def error_line(tb):
+    """Returns the last line of the formatted traceback `tb`, which
+    names the exception
+    """
+    return tb.strip().splitlines()[-1]
+
+
+class RecordingHandler(logging.Handler):
+    """Keeps log records around so a worker can hand them back to the
+    parent process, instead of writing them out of order.
+    """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        # args and exc_info may not pickle, so format the message now
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        self.records.append(record)
+
+
+_worker_config = None
+_worker_log = None
+
+
+def _init_worker(properties, options, index):
+    global _worker_config, _worker_log
+    # each worker gets its own Config, and so its own template_env
+    _worker_config = Config(properties=properties, options=options)
+    _worker_config.index = index
+    _worker_log = RecordingHandler()
+    logging.getLogger().handlers = [_worker_log]
+    if options.profile:
+        timing.enable()
+
+
+def _build_in_worker(src_file):
+    """Builds `src_file` and returns a dict of what the parent needs to
+    know: its outputs and inputs, when it started, how long it took, how
+    many bytes it wrote and how far it raised RSS, log records, the
+    formatted error if it failed, the changes in `Config.stats`,
+    dependency graph updates, and timings if profiling
+    """
+    _worker_log.records = []
+    before = _worker_config.stats()
+    result = {'outputs': None, 'inputs': None, 'error': None,
+              'started': time.time()}
+    try:
+        result['outputs'] = build_source(_worker_config, src_file)
+        result['inputs'] = file_inputs(_worker_config, src_file)
+        result['bytes'] = output_bytes(_worker_config, result['outputs'])
+        result['rss'] = _worker_config.page_rss.pop(src_file, None)
+    except Exception:
+        result['error'] = traceback.format_exc()
+    result['duration'] = time.time() - result['started']
+    result['records'] = _worker_log.records
+    result['stats'] = diff_stats(before, _worker_config.stats())
+    result['deps'] = dependency_graph(_worker_config).take_updates()
+    if timing.profiler():
+        result['timings'] = timing.profiler().take()
+    return result
+
+
+# stats are counters, except those ending in _max, which are maximums
+def diff_stats(before, after):
+    return dict((k, v if k.endswith('_max') else v - before.get(k, 0))
+                for k, v in after.iteritems())
+
+
+def add_stats(totals, stats):
+    for k, v in stats.iteritems():
+        if k.endswith('_max'):
+            totals[k] = max(totals.get(k, 0), v)
+        else:
+            totals[k] = totals.get(k, 0) + v
+
+
+def report_stats(stats):
+    for name, prefix in [('Context cache', 'context_cache'),
+                         ('Compile cache', 'compile_cache'),
+                         ('Markdown cache', 'markdown_cache')]:
+        hits = stats.get(prefix + '_hits', 0)
+        misses = stats.get(prefix + '_misses', 0)
+        if hits or misses:
+            logging.info("%s: %d hits, %d misses" % (name, hits, misses))
+    written = stats.get('outputs_written', 0)
+    unchanged = stats.get('outputs_unchanged', 0)
+    removed = stats.get('outputs_removed', 0)
+    if written or unchanged or removed:
+        logging.info("Outputs: %d written, %d unchanged, %d removed" % \
+                     (written, unchanged, removed))
+    if stats.get('page_peak_rss_max') or stats.get('pages_streamed'):
+        logging.info("Pages: %d streamed, rendering one raised RSS by up "
+                     "to %d KB" % (stats.get('pages_streamed', 0),
+                                   stats.get('page_peak_rss_max', 0)))
+
+
+def build_sources(config, src_files, manifest):
+    """Builds each of `src_files`, recording them in `manifest`. With
+    more than one job, files are built in a pool of worker processes,
+    and their logs and build events are replayed here in the order of
+    `src_files`.
+
+    Returns the workers' `Config.stats`, summed; these aren't counted
+    in `config.stats()`.
+    """
+    totals = {}
+    events = build_events(config)
+    jobs = config.options.jobs
+    if jobs <= 1 or len(src_files) <= 1:
+        for src_file in src_files:
+            start = time.time()
+            events.emit(STARTED, src_file, start)
+            try:
+                inputs = file_inputs(config, src_file)
+                outputs = build_source(config, src_file)
+            except Exception:
+                events.emit(FAILED, src_file, duration=time.time() - start,
+                            error=error_line(traceback.format_exc()))
+                raise
+            events.emit(FINISHED, src_file, duration=time.time() - start,
+                        bytes=output_bytes(config, outputs), outputs=outputs,
+                        rss=config.page_rss.pop(src_file, None))
+            manifest.record(src_file, inputs, outputs)
+        return totals
+
+    pool = multiprocessing.Pool(jobs, _init_worker,
+                                (config._properties, config.options,
+                                 config.index))
+    try:
+        results = pool.imap(_build_in_worker, src_files)
+        graph = dependency_graph(config)
+        for src_file, result in izip(src_files, results):
+            for record in result['records']:
+                logging.getLogger(record.name).handle(record)
+            add_stats(totals, result['stats'])
+            graph.merge(*result['deps'])
+            if 'timings' in result:
+                timing.profiler().merge(*result['timings'])
+            events.emit(STARTED, src_file, result['started'])
+            if result['error']:
+                events.emit(FAILED, src_file, result['started'],
+                            duration=result['duration'],
+                            error=error_line(result['error']))
+                logging.error("Failed to build %s:\n%s" % \
+                              (src_file, result['error']))
+                raise SystemExit(1)
+            events.emit(FINISHED, src_file,
+                        result['started'] + result['duration'],
+                        duration=result['duration'], bytes=result['bytes'],
+                        outputs=result['outputs'], rss=result['rss'])
+            manifest.record(src_file, result['inputs'], result['outputs'])
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return totals
+
+
+def build_global_data(config, manifest, force=False):
+    """Builds the global context's data file, if it changed"""
+    global_file = osp.join(config.data_directory, config.base_context_filename)
+    if force or not manifest.is_fresh(global_file):
+        global_dest = reroot(global_file,
+                             srcdir=config.data_directory,
+                             destdir=osp.abspath(config.build_data_directory))
+        outputs = filter(None, [build_data(config, global_file, global_dest)])
+        manifest.record(global_file, context_candidates(global_file), outputs)
+
+
+def load_manifest(config, shard):
+    """Returns the manifest for a build of `shard`, or of everything if
+    it's None. A shard without a manifest of its own, as after `merge`,
+    starts from the entries of the merged manifest that are in it.
+    """
+    path = manifest_path(config)
+    manifest = Manifest.load(path)
+    if shard and not osp.exists(path):
+        merged = Manifest.load(manifest_path(config, sharded=False))
+        src_dir = osp.abspath(config.src_directory) + os.sep
+        manifest.entries = dict(
+            (k, e) for k, e in merged.entries.iteritems()
+            if k.startswith(src_dir) and in_shard(k[len(src_dir):], shard))
+        manifest.settings = merged.settings
+    return manifest
+
+
+def remove_outputs(config, paths):
+    """Removes those of `paths` that exist within the build and build
+    data directories, and any directories there that are left empty.
+    Paths elsewhere, e.g. from a manifest copied from another checkout,
+    are never removed. Returns the number of files removed.
+    """
+    roots = set(osp.abspath(d) for d in (config.build_directory,
+                                         config.build_data_directory))
+    prefixes = tuple(r + os.sep for r in roots)
+    removed = 0
+    outside = 0
+    for path in sorted(paths):
+        if not osp.normpath(path).startswith(prefixes):
+            outside += 1
+            continue
+        if not osp.lexists(path):
+            continue
+        logging.info("Removing stale output: %s" % path)
+        config.output.remove(path)
+        removed += 1
+
+        parent = osp.dirname(path)
+        while (parent not in roots and
+               any(parent.startswith(r + os.sep) for r in roots)):
             try:
-                if self.path == '/':
-                    self.path = '/index.html'
-
-                base_ctx = config.base_context() or {}
-                src_file = osp.join(src_dir, self.path[1:])
-
-                dest_file = reroot(src_file,
-                                   srcdir=src_dir,
-                                   destdir=build_dir)
-
-                # don't even check if file exists, raise an error if it doesn't
-                try:
-                    dest_file = build_file(config, src_file, dest_file)
-                    self.send_response(200)
-                    self.send_header('Content-Type', mimeof(dest_file))
-                    self.end_headers()
-
-                    with open(dest_file) as f:
-                        self.wfile.write(f.read())
-                except IOError:
-                    self.send_response(404)
-                    self.send_header('Content-Type', 'text/plain')
-                    self.wfile.write("404 Not found")
-            except:
-                self.send_response(500)
-                self.send_header('Content-Type', 'text/plain')
-                self.end_headers()
-                traceback.print_exc(file=self.wfile)
-
-    return BuildHandler
+                os.rmdir(parent)
+            except OSError:
+                # not empty
+                break
+            logging.debug("Removing empty directory %s" % parent)
+            parent = osp.dirname(parent)
+
+    if outside:
+        logging.warning("Not removing %d stale output(s) outside the build "
+                        "directories" % outside)
+    if removed:
+        config.output.forget_dirs()
+    return removed
+
+
+def forget_sources(config, manifest, src_files):
+    """Drops the removed `src_files` from `manifest` and the dependency
+    graph, and removes their outputs, unless another source builds them
+    too. Returns the number of files removed.
+    """
+    entries = [manifest.entries.pop(f) for f in src_files
+               if f in manifest.entries]
+    graph = dependency_graph(config)
+    for f in src_files:
+        graph.remove_page(f)
+
+    stale = set(o for e in entries for o in e['outputs'])
+    return remove_outputs(config, stale - manifest.outputs())
+
+
+def prune_outputs(config, manifest, src_files, previous):
+    """Makes the manifest forget sources that aren't among `src_files`
+    any more, then removes the files in `previous`, what the manifest
+    said the build had written before it started, that the build
+    doesn't write any more, and any directories left empty. Files the
+    build never wrote, like a `.git` directory or a `CNAME`, are left
+    alone.
+
+    Returns the number of files removed.
+    """
+    global_file = osp.join(config.data_directory, config.base_context_filename)
+    keep = set(src_files)
+    keep.add(global_file)
+    graph = dependency_graph(config)
+    for key in manifest.retain(keep):
+        graph.remove_page(key)
+
+    current = derived_outputs(config, manifest.outputs())
+    manifest.extra = sorted(current - manifest.outputs())
+    return remove_outputs(config, previous - current)
+
+
+def record_extra(config, manifest):
+    """Adds the fingerprinted and precompressed copies the build may
+    have made to `manifest.extra`, so that a later build can remove
+    them once they're not made any more
+    """
+    extra = derived_outputs(config, manifest.outputs()).union(manifest.extra)
+    manifest.extra = sorted(extra - manifest.outputs())
+
+
+def finish_rebuild(config, manifest, rebuilt):
+    """Does for the sources in `rebuilt`, just rebuilt by `watch`, what
+    `build` does after building: fingerprints the assets and rebuilds
+    the pages whose fingerprints changed, then precompresses whatever
+    was rebuilt. Returns the pages rebuilt.
+    """
+    pages = []
+    if config.fingerprint_assets:
+        fingerprint_assets(config, manifest.outputs())
+        pages = sorted(k for k in manifest.entries
+                       if k.endswith('.html') and config.index.exists(k) and
+                       not manifest.is_fresh(k))
+        build_events(config).expect(len(pages))
+        build_sources(config, pages, manifest)
+
+    outputs = set(o for key in list(rebuilt) + pages
+                  for o in manifest.entries.get(key, {}).get('outputs', ()))
+    compress_outputs(config, derived_outputs(config, outputs))
+    record_extra(config, manifest)
+    return pages
+
+
+def affected_sources(config, manifest, changed):
+    """Returns the sources that need rebuilding, and whether the global
+    data file does, after the files in `changed` were modified: changed
+    sources themselves, plus anything the manifest lists as depending
+    on a changed file (data contexts, templates, the global context).
+    """
+    src_dir = osp.abspath(config.src_directory) + os.sep
+    graph = dependency_graph(config)
+    dependents = {}
+    for key, entry in manifest.entries.iteritems():
+        for path in entry['inputs']:
+            dependents.setdefault(path, []).append(key)
+
+    keys = set()
+    for path in changed:
+        if path.startswith(src_dir):
+            keys.add(path)
+        keys.update(dependents.get(path, ()))
+        keys.update(graph.dependents(path))
+
+    global_file = osp.join(config.data_directory, config.base_context_filename)
+    rebuild_global = global_file in keys
+    keys.discard(global_file)
+
+    src_files = sorted(k for k in keys
+                       if osp.isfile(k) and not manifest.is_fresh(k))
+    return src_files, rebuild_global
+
 
 @task(priority=1)
-def build(config):
-    """Rebuilds the site.
+def build(config, *patterns):
+    """Rebuilds the site. Sources whose inputs haven't changed since
+    the last build are skipped, unless --force is given or one of the
+    manifest's SETTINGS_PROPERTIES changed. Use -j to build with
+    several processes.
+
+    Given glob patterns (e.g. 'blog/**'), only matching sources, relative
+    to the source directory, are built. With --shard I/N, only the
+    sources in shard I are built, and the global data file is left for
+    the merge task.
+
+    With `fingerprint_assets`, assets are built and fingerprinted before
+    pages, so that `asset_url` finds them. Outputs are precompressed
+    with the encodings in `precompress`.
+
+    Every source built or skipped is reported to the sinks listed in
+    `build_events`; by default, a line of progress is logged.
     """
     sanity_check(config)
 
-    src_dir = osp.abspath(config.src_directory)
+    try:
+        shard = parse_shard(config.options.shard)
+    except ValueError, e:
+        logging.fatal(str(e))
+        raise SystemExit(1)
+
+    # one pass over the trees; everything after asks the index, not the disk
+    config.index = TreeIndex([config.src_directory, config.data_directory,
+                              osp.join(config.layout_directory, config.layout)])
+    manifest = load_manifest(config, shard)
+    manifest.index = config.index
+    previous = manifest.written()
+    force = config.options.force
+    settings = settings_digest(config)
+    if manifest.settings != settings:
+        if manifest.entries and not force:
+            logging.info("Settings changed since the last build, "
+                         "rebuilding everything")
+        force = True
+        manifest.settings = settings
+        # templates may resolve to other files now
+        dependency_graph(config).clear()
+    fingerprint = config.fingerprint_assets and not shard
+    events = build_events(config)
+    pending = []
+    pages = []
+    fresh = []
+
+    src_prefix = len(osp.abspath(config.src_directory)) + 1
+    for src_file in config.index.files(config.src_directory):
+        rel = src_file[src_prefix:]
+        if patterns and not any(fnmatch.fnmatch(rel, p) for p in patterns):
+            continue
+        if shard and not in_shard(rel, shard):
+            continue
+        if fingerprint and src_file.endswith('.html'):
+            # whether they're fresh depends on the assets, built first
+            pages.append(src_file)
+        elif not force and manifest.is_fresh(src_file):
+            fresh.append(src_file)
+        else:
+            pending.append(src_file)
+
+    events.expect(len(pending) + len(pages) + len(fresh))
+    for src_file in fresh:
+        events.emit(SKIPPED, src_file)
+
+    # compile what we can in bulk, so the builders find it in the cache
+    compiler_pool(config).compile_many(pending)
+
+    try:
+        stats = build_sources(config, pending, manifest)
+        if fingerprint:
+            fingerprint_assets(config, manifest.outputs())
+            stale = []
+            for page in pages:
+                if force or not manifest.is_fresh(page):
+                    stale.append(page)
+                else:
+                    events.emit(SKIPPED, page)
+            add_stats(stats, build_sources(config, stale, manifest))
+    finally:
+        manifest.save()
+        dependency_graph(config).save()
+        events.flush()
+
+    if not shard:
+        build_global_data(config, manifest, force)
+    if not patterns and not shard and config.prune_outputs:
+        prune_outputs(config, manifest,
+                      config.index.files(config.src_directory), previous)
+        dependency_graph(config).save()
+    if not shard:
+        compress_outputs(config, derived_outputs(config, manifest.outputs()))
+
+    record_extra(config, manifest)
+    manifest.save()
+    add_stats(stats, config.stats())
+    report_stats(stats)
+
+    profiler = timing.profiler()
+    if profiler:
+        profiler.report(config.options.profile_top)
+        dump = config.options.profile_dump
+        if dump and dump.endswith('.json'):
+            profiler.dump(dump)
+
+
+@task(priority=2)
+def merge(config):
+    """Merges the build manifests and dependency graphs left in the
+    build directory by sharded builds (see --shard), builds the global
+    data file and precompresses the outputs.
+    """
     build_dir = osp.abspath(config.build_directory)
-    build_data_dir = osp.abspath(config.build_data_directory)
+    config.options.shard = None
+    manifest = Manifest.load(manifest_path(config))
+    graph = dependency_graph(config)
+
+    for path in sorted(glob.glob(osp.join(
+                build_dir, shard_filename(MANIFEST_FILENAME, None)))):
+        logging.info("Merging %s" % path)
+        manifest.entries.update(Manifest.load(path).entries)
+        os.unlink(path)
+
+    for path in sorted(glob.glob(osp.join(
+                build_dir, shard_filename(DEPS_FILENAME, None)))):
+        logging.info("Merging %s" % path)
+        shard_graph = DependencyGraph.load(config.template_env, path)
+        graph.merge(shard_graph.templates, shard_graph.pages)
+        os.unlink(path)
+
+    settings = settings_digest(config)
+    build_global_data(config, manifest, manifest.settings != settings)
+    manifest.settings = settings
+    compress_outputs(config, derived_outputs(config, manifest.outputs()))
+    record_extra(config, manifest)
+    manifest.save()
+    graph.save()
 
-    for root, dirs, files in os.walk(config.src_directory):
-        for f in files:
-            root = osp.abspath(root)
-            src_file = osp.join(root, f)
-            dest_file = reroot(src_file,
-                               srcdir=src_dir,
-                               destdir=build_dir)
-            build_file(config, src_file, dest_file)
-
-            if f.endswith('.html'):
-                dest_data_file = reroot(src_file,
-                                        srcdir=src_dir,
-                                        destdir=build_data_dir)
-                build_data(config, src_file, dest_data_file)
-
-    # build global data
+
+@task(priority=1)
+def watch(config):
+    """Builds the site, then watches the source, data and layout
+    directories and rebuilds whatever a change affects, fingerprinting
+    and precompressing the outputs as `build` does.
+    """
+    # pyinotify is slow to import
+    from watch import make_watcher, wait_for_changes
+
+    build(config)
+
+    roots = [osp.abspath(config.src_directory),
+             osp.abspath(config.data_directory),
+             osp.join(osp.abspath(config.layout_directory), config.layout)]
+    watcher = make_watcher(roots, config.watch_interval)
+    logging.info("Watching %s for changes" % ', '.join(watcher.roots))
+
+    manifest = Manifest.load(manifest_path(config))
+    manifest.index = config.index
     global_file = osp.join(config.data_directory, config.base_context_filename)
-    global_dest = reroot(global_file, 
-                         srcdir=config.data_directory,
-                         destdir=build_data_dir)
-    build_data(config, global_file, global_dest)
+    try:
+        while True:
+            changed = wait_for_changes(watcher, config.watch_debounce)
+            start = time.time()
+            for path in changed:
+                config.index.invalidate(path)
+            src_files, rebuild_global = affected_sources(config, manifest,
+                                                         changed)
+            try:
+                if config.prune_outputs:
+                    forget_sources(config, manifest,
+                                   [p for p in changed
+                                    if p in manifest.entries and
+                                    not config.index.exists(p)])
+                compiler_pool(config).compile_many(src_files)
+                build_events(config).expect(len(src_files))
+                build_sources(config, src_files, manifest)
+                rebuilt = list(src_files)
+                if rebuild_global:
+                    build_global_data(config, manifest)
+                    rebuilt.append(global_file)
+                src_files += finish_rebuild(config, manifest, rebuilt)
+            except (Exception, SystemExit):
+                # keep watching; the next change may well fix it
+                logging.error("Rebuild failed:\n%s" % traceback.format_exc())
+            finally:
+                manifest.save()
+                dependency_graph(config).save()
+                build_events(config).flush()
+            logging.info("Rebuilt %d file(s) for %d change(s) in %.3fs" % \
+                         (len(src_files) + bool(rebuild_global), len(changed),
+                          time.time() - start))
+    except KeyboardInterrupt:
+        pass
+
+
+@task(priority=1)
+def deps(config, *files):
+    """Prints the templates each given file uses, and the pages that
+    would need rebuilding if it changed.
+    """
+    src_dir = osp.abspath(config.src_directory)
+    graph = dependency_graph(config)
+    for root, dirs, names in os.walk(src_dir):
+        for name in names:
+            if name.endswith('.html'):
+                src_file = osp.join(root, name)
+                graph.add_page(src_file, page_name(config, src_file))
+    graph.save()
+
+    for f in files:
+        f = osp.abspath(f)
+        print f
+        if f.startswith(src_dir + os.sep):
+            print '  uses:'
+            for t in graph.templates_of(page_name(config, f)):
+                if t != f and osp.exists(t):
+                    print '   ', t
+        print '  rebuilds:'
+        for page in graph.dependents(f):
+            print '   ', page
+
+
+@task(priority=1)
+def precompile(config):
+    """Compiles every layout and page template into the bytecode cache,
+    so builds don't have to.
+    """
+    env = config.template_env
+    names = env.list_templates(extensions=['html'])
+    for name in names:
+        logging.debug("Compiling template %s" % name)
+        env.get_template(name)
+    logging.info("Compiled %d templates into %s" % \
+                 (len(names), env.bytecode_cache.directory))
 
 
 @task(priority=1)
 def develop(config):
     """Starts a webserver that rerenders and serves dynamically
-    generated pages
+    generated pages, on `bind_host`:`bind_port`, with `server_workers`
+    threads. With `develop_output = memory`, the last
+    `develop_cache_size` outputs are kept in memory, and the build
+    directory is left alone.
     """
-    httpd = BaseHTTPServer.HTTPServer((BIND_HOST, BIND_PORT),
-                                      make_handler(config))
-    logging.info("Listening on http://%s:%d" % (BIND_HOST, BIND_PORT))
+    # the server isn't needed by anything else, so it's imported here
+    from server import PooledHTTPServer, make_handler
+
+    address = (config.bind_host, config.bind_port)
+    httpd = PooledHTTPServer(address, make_handler(config),
+                             config.server_workers)
+    logging.info("Listening on http://%s:%d" % address)
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
         pass
     httpd.server_close()
-    logging.info("Stopped listening on http://localhost:1432")
+    logging.info("Stopped listening on http://%s:%d" % address)
 
 
 @task(priority=1)
@@ -162,9 +681,31 @@ def clean(config):
             os.unlink(fp)
         rmdirs.extend(osp.join(root, d) for d in dirs)
 
-    for d in rmdirs:
+    # children before their parents
+    for d in reversed(rmdirs):
         logging.debug("Removing directory %s" % d)
         os.rmdir(d)
+    config.output.forget_dirs()
+
+
+@task(priority=1, name='cache-stats')
+def cache_stats(config):
+    """Prints the size of the compile cache.
+    """
+    cache = config.compile_cache
+    entries = cache.entries()
+    size = sum(st.st_size for _, st in entries)
+    print 'Compile cache:', cache.directory
+    print '  entries: %d' % len(entries)
+    print '  size: %d bytes (limit %d)' % (size, cache.max_size)
+
+
+@task(priority=1, name='cache-clear')
+def cache_clear(config):
+    """Deletes everything in the compile cache.
+    """
+    logging.info("Clearing compile cache %s" % config.compile_cache.directory)
+    config.compile_cache.clear()
 
 
 @task(priority=0)
@@ -195,7 +736,7 @@ def help(config, *args):
     """Prints a helpful help message.
     """
     if len(args) == 1:
-        task = TASKS.get(args[0])
+        task = find_task(args[0])
         if task:
             print task['name']
             print '---'
@@ -206,7 +747,7 @@ def help(config, *args):
     else:
         print 'Available tasks'
         print '---'
-        for name in sorted(TASKS.keys()):
+        for name in sorted(set(TASKS) | set(entry_points(TASKS_GROUP))):
             print ' ', name
         print
 
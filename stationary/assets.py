@@ -0,0 +1,293 @@
+import gzip
+import hashlib
+import logging
+import multiprocessing
+import os
+import os.path as osp
+
+from output import OutputWriter
+from utils import mimeof
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+ASSETS_FILENAME = '.stationary-assets.json'
+ASSETS_VERSION = 1
+
+# encoding, as in Accept-Encoding -> suffix of the precompressed file
+ENCODINGS = {
+    'gzip': '.gz',
+    'br': '.br',
+}
+
+# compressible types besides text/*
+COMPRESSIBLE_TYPES = (
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'application/x-javascript',
+    'image/svg+xml',
+)
+
+
+def assets_path(config):
+    return osp.join(osp.abspath(config.build_directory), ASSETS_FILENAME)
+
+
+def is_compressible(path):
+    if path.endswith(tuple(ENCODINGS.values())):
+        return False
+    t = mimeof(path)
+    return t.startswith('text/') or t in COMPRESSIBLE_TYPES
+
+
+def fingerprinted_name(path, digest):
+    """Returns `path` with `digest` worked in before its extension, e.g.
+    'css/base.1a2b3c4d.css'
+    """
+    base, ext = osp.splitext(path)
+    return '%s.%s%s' % (base, digest[:8], ext)
+
+
+def is_current(path, st):
+    """Returns True if `path`, a fingerprinted or precompressed copy,
+    has the mtime of the output `st` was stat'ed from. Copies are given
+    their output's mtime when they're made; setting it loses precision,
+    hence the tolerance.
+    """
+    try:
+        return abs(os.stat(path).st_mtime - st.st_mtime) < 0.001
+    except OSError:
+        return False
+
+
+def precompress_encodings(config):
+    """Returns the encodings in `precompress` that can be produced here"""
+    encodings = []
+    for encoding in config.precompress:
+        if encoding not in ENCODINGS:
+            logging.warning("Unknown precompress encoding '%s'" % encoding)
+        elif encoding == 'br' and brotli is None:
+            logging.warning("Can't precompress with br: the brotli module "
+                            "isn't installed")
+        else:
+            encodings.append(encoding)
+    return encodings
+
+
+class AssetMap(object):
+    """Maps assets, by path relative to the build directory, to their
+    fingerprinted copies. Templates look them up with `asset_url`.
+    """
+
+    def __init__(self, path, assets=None):
+        self.path = path
+        self.assets = assets or {}
+        self.mtime = None
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+                mtime = os.fstat(f.fileno()).st_mtime
+        except (IOError, ValueError):
+            return cls(path)
+        if data.get('version') != ASSETS_VERSION:
+            return cls(path)
+        amap = cls(path, data.get('assets'))
+        amap.mtime = mtime
+        return amap
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'version': ASSETS_VERSION, 'assets': self.assets}, f,
+                      indent=1, sort_keys=True)
+        os.rename(tmp, self.path)
+        self.mtime = os.stat(self.path).st_mtime
+
+    def url(self, path):
+        """Returns the URL of the fingerprinted copy of the asset at URL
+        `path`, or `path` itself if there's none
+        """
+        name = self.assets.get(path.lstrip('/'))
+        if name is None:
+            return path
+        return path[:len(path) - len(path.lstrip('/'))] + name
+
+    def source(self, name):
+        """Returns the path of the asset fingerprinted as `name`, or None"""
+        for path, fingerprinted in self.assets.iteritems():
+            if fingerprinted == name:
+                return path
+        return None
+
+    def files(self, build_dir):
+        """Returns the paths of the fingerprinted copies"""
+        return set(osp.join(build_dir, n) for n in self.assets.itervalues())
+
+
+def asset_map(config):
+    """Returns the AssetMap for `config`, loading it from the build
+    directory the first time, and again whenever another process saves
+    it
+    """
+    amap = getattr(config, '_asset_map', None)
+    path = assets_path(config)
+    if amap is not None:
+        try:
+            if os.stat(path).st_mtime == amap.mtime:
+                return amap
+        except OSError:
+            return amap
+    amap = config._asset_map = AssetMap.load(path)
+    return amap
+
+
+def asset_url(config):
+    """Returns the `asset_url` template global for `config`"""
+    def url(path):
+        if not config.fingerprint_assets:
+            return path
+        return asset_map(config).url(path)
+    return url
+
+
+def derived_outputs(config, outputs):
+    """Returns `outputs`, plus the fingerprinted and precompressed files
+    made from them
+    """
+    files = set(outputs)
+    if config.fingerprint_assets:
+        files.update(asset_map(config).files(
+                osp.abspath(config.build_directory)))
+    suffixes = [ENCODINGS[e] for e in config.precompress if e in ENCODINGS]
+    files.update([f + s for f in files for s in suffixes])
+    return files
+
+
+def is_fingerprinted(config, output):
+    """Returns True if `output` is an asset that gets a fingerprinted
+    copy: anything in the build directory that isn't a page or data
+    """
+    build_dir = osp.abspath(config.build_directory) + os.sep
+    data_dir = osp.abspath(config.build_data_directory) + os.sep
+    return (output.startswith(build_dir) and
+            not output.startswith(data_dir) and
+            mimeof(output) != 'text/html')
+
+
+def fingerprint_assets(config, outputs):
+    """Gives each asset among `outputs` a copy named after a hash of its
+    contents, and records them in the asset map. Assets whose copy is
+    as old as they are aren't hashed again.
+    """
+    build_dir = osp.abspath(config.build_directory)
+    amap = asset_map(config)
+    assets = {}
+    for output in sorted(outputs):
+        if not is_fingerprinted(config, output):
+            continue
+        try:
+            st = os.stat(output)
+        except OSError:
+            continue
+        rel = output[len(build_dir) + 1:]
+        name = amap.assets.get(rel)
+        if name:
+            if is_current(osp.join(build_dir, name), st):
+                assets[rel] = name
+                continue
+
+        h = hashlib.sha1()
+        with open(output, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), ''):
+                h.update(chunk)
+        name = fingerprinted_name(rel, h.hexdigest())
+        logging.debug("Fingerprinting %s as %s" % (rel, name))
+        config.output.copy(output, osp.join(build_dir, name),
+                           config.copy_strategy, st)
+        assets[rel] = name
+
+    if assets != amap.assets or amap.mtime is None:
+        amap.assets = assets
+        amap.save()
+
+
+def _compress(args):
+    """Writes the precompressed siblings of `path` that are missing or
+    out of date. Returns how many were written and unchanged.
+    """
+    path, encodings = args
+    output = OutputWriter()
+    st = os.stat(path)
+    data = None
+    for encoding in encodings:
+        dest = path + ENCODINGS[encoding]
+        if is_current(dest, st):
+            continue
+        if data is None:
+            with open(path, 'rb') as f:
+                data = f.read()
+        if encoding == 'gzip':
+            with output.open(dest) as f:
+                gz = gzip.GzipFile(osp.basename(path), 'wb', 9, f,
+                                   st.st_mtime)
+                gz.write(data)
+                gz.close()
+        else:
+            output.write(dest, brotli.compress(data))
+        # matching mtimes mark it up to date
+        os.utime(dest, (st.st_atime, st.st_mtime))
+    return output.written, output.unchanged
+
+
+def compress_outputs(config, outputs):
+    """Writes precompressed siblings (e.g. `.gz`) of those `outputs` of a
+    compressible type and at least `precompress_min_size` bytes, in
+    parallel. Siblings already as old as their output are left alone.
+    """
+    encodings = precompress_encodings(config)
+    if not encodings:
+        return
+
+    todo = []
+    for output in sorted(outputs):
+        if not is_compressible(output):
+            continue
+        try:
+            st = os.stat(output)
+        except OSError:
+            continue
+        if st.st_size < config.precompress_min_size:
+            continue
+        if not all(is_current(output + ENCODINGS[e], st) for e in encodings):
+            todo.append((output, encodings))
+
+    if not todo:
+        return
+    logging.info("Compressing %d file(s)" % len(todo))
+    jobs = min(multiprocessing.cpu_count(), len(todo))
+    if jobs <= 1:
+        results = map(_compress, todo)
+    else:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = pool.map(_compress, todo, chunksize=16)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    for written, unchanged in results:
+        config.output.written += written
+        config.output.unchanged += unchanged
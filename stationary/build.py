@@ -1,14 +1,20 @@
+import errno
+import fnmatch
 import logging
-import os
 import os.path as osp
+import shutil
+import resource
 import subprocess
+import tempfile
+import threading
 
-from jinja2 import evalcontextfilter, Markup
-from markdown import markdown as convert_markdown
-from collections import defaultdict
-from utils import reroot
+from cache import compile_key, run_compiler
+from config import find_context_file
+from deps import page_name
+from plugins import BUILDERS_GROUP, load_plugin
+from timing import timed
 
-__BUILDERS = defaultdict(lambda: build_static)
+__BUILDERS = {}
 
 try:
     import json
@@ -16,6 +22,140 @@ except ImportError:
     import simplejson as json
 
 
+class CompilerError(Exception):
+    pass
+
+
+# extension -> (command, flags to print one file, flags to compile many
+# files into a directory given with -o)
+COMPILERS = {
+    '.coffee': ('coffee', ['--print'], ['-c']),
+    '.iced': ('iced', ['--runtime', 'inline', '--print'],
+              ['--runtime', 'inline', '-c']),
+    '.less': ('lessc', [], None),
+}
+
+# most files passed to a single batch invocation
+BATCH_SIZE = 200
+
+# template events joined into each write when streaming a page
+STREAM_BUFFER = 64
+
+# writes between samples of RSS when streaming a page
+SAMPLE_EVERY = 16
+
+PAGE_SIZE = resource.getpagesize()
+
+
+class CompilerPool(object):
+    """Runs the external compilers, no more than `size` at once.
+
+    `compile_many` compiles many sources with one compiler invocation,
+    instead of paying for a Node startup per file, and stores the
+    outputs in the compile cache for `compile` to pick up.
+    """
+
+    def __init__(self, cache, size):
+        self.cache = cache
+        self.size = size
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _run(self, cmd, func, *args):
+        with self._slots:
+            try:
+                return func(*args)
+            except OSError, e:
+                if e.errno == errno.ENOENT:
+                    raise CompilerError("Compiler '%s' was not found on "
+                                        "the PATH" % cmd)
+                raise
+
+    def compile(self, ext, src_file):
+        """Returns the output of compiling `src_file`"""
+        cmd, flags, _ = COMPILERS[ext]
+        return self._run(cmd, run_compiler, self.cache, [cmd] + flags, src_file)
+
+    def compile_many(self, src_files):
+        """Compiles those of `src_files` that aren't already cached, in
+        as few compiler invocations as possible.
+
+        Raises CompilerError if a compiler isn't on the PATH. Other
+        failures, of a batch or of a file within it, are only logged at
+        debug level; compiling the file alone with `compile` reports
+        the error.
+        """
+        batches = []
+        for ext, (cmd, flags, batch_flags) in COMPILERS.iteritems():
+            if batch_flags is None:
+                continue
+            srcs = [f for f in src_files if f.endswith(ext)]
+            if not srcs:
+                continue
+            keys = self._run(cmd, lambda: dict(
+                    (f, compile_key(self.cache, [cmd] + flags, f))
+                    for f in srcs))
+            srcs = [f for f in srcs if keys[f] not in self.cache]
+            batches.extend(([cmd] + batch_flags, b, keys)
+                           for b in self._batches(srcs))
+
+        threads = [threading.Thread(target=self._run,
+                                    args=(b[0][0], self._compile_batch) + b)
+                   for b in batches]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def _batches(self, src_files):
+        """Splits `src_files` into batches without repeated basenames,
+        since the compiler writes every output into the same directory
+        """
+        batches = []
+        for f in src_files:
+            name = osp.basename(f)
+            for names, batch in batches:
+                if name not in names and len(batch) < BATCH_SIZE:
+                    break
+            else:
+                names, batch = set(), []
+                batches.append((names, batch))
+            names.add(name)
+            batch.append(f)
+        return [files for _, files in batches]
+
+    def _compile_batch(self, argv, src_files, keys):
+        out_dir = tempfile.mkdtemp(prefix='stationary-')
+        try:
+            logging.debug("Compiling %d files with %s" % \
+                          (len(src_files), argv[0]))
+            try:
+                subprocess.check_output(argv + ['-o', out_dir] + src_files,
+                                        stderr=subprocess.STDOUT)
+            except subprocess.CalledProcessError, e:
+                logging.debug("Batch compile with %s failed: %s" % \
+                              (argv[0], e.output))
+                return
+
+            for f in src_files:
+                base, _ = osp.splitext(osp.basename(f))
+                try:
+                    with open(osp.join(out_dir, base + '.js'), 'rb') as o:
+                        self.cache.put(keys[f], o.read())
+                except IOError, e:
+                    logging.debug("No batch output for %s: %s" % (f, e))
+        finally:
+            shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def compiler_pool(config):
+    """Returns the CompilerPool for `config`, creating it if needed"""
+    pool = getattr(config, '_compiler_pool', None)
+    if pool is None:
+        pool = config._compiler_pool = CompilerPool(config.compile_cache,
+                                                    config.compilers)
+    return pool
+
+
 def register(*exts):
     """Registers function as a builder, which will build passed in `src_file`
     and returns the destination, given `config` and `src_file`
@@ -27,6 +167,20 @@ def register(*exts):
     return decorator
 
 
+def builder(ext):
+    """Returns the builder for files with extension `ext`: a registered
+    one, one provided by another package as a `stationary.builders`
+    entry point named after the extension (e.g. '.rst'), which is
+    imported the first time it's needed, or `build_static`
+    """
+    func = __BUILDERS.get(ext)
+    if func is None:
+        func = __BUILDERS[ext] = (load_plugin(BUILDERS_GROUP, ext) or
+                                  build_static)
+    return func
+
+
+@timed(per_file=True)
 def build_file(config, src_file, dest_file):
     """Dispatches to the appropriate builder given file extension
 
@@ -34,73 +188,156 @@ def build_file(config, src_file, dest_file):
     built. This allows handlers to change extensions as part of the
     build process (for coffee, less, etc)
     """
-    dest_dir = osp.dirname(dest_file)
-    if not osp.exists(dest_dir):
-        os.makedirs(dest_dir)
-
     _, ext = osp.splitext(src_file)
-    return __BUILDERS[ext](config, src_file, dest_file)
+    return builder(ext)(config, src_file, dest_file)
         
 
+@timed(per_file=True)
 def build_data(config, src_file, dest_file):
-    """Builds data file, by loading the data context and writing it
-    out to the data directory
+    """Builds data file, by writing the data context out to the data
+    directory. Plain JSON contexts are copied as is; preprocessed ones
+    are written from the (cached) context used for rendering.
+
+    Returns None, without writing anything, if there's no context.
     """
     src_file = src_file.replace('.html', '.json')
-    data_ctx = config.read_context(src_file)
+    try:
+        data_file, cmd = find_context_file(config.context_path(src_file),
+                                           config.index)
+    except ValueError, e:
+        logging.warning(str(e))
+        return None
+    if not data_file:
+        logging.debug("No data context for %s" % src_file)
+        return None
+
     dest_file = dest_file.replace('.html', '.json')
-    
-    dest_dir = osp.dirname(dest_file)
 
-    if not osp.exists(dest_dir):
-        os.makedirs(dest_dir)
+    if cmd is None:
+        data_st = config.index.stat(data_file)
+        if not config.output.has_copy(data_st, dest_file):
+            logging.debug("Copying data file: %s to %s" % \
+                          (data_file, dest_file))
+            config.output.copy(data_file, dest_file, config.copy_strategy,
+                               data_st)
+        return dest_file
 
-    logging.info("Rendering data file: %s to %s" % (src_file, dest_file))
-    with open(dest_file, 'w') as f:
-        json.dump(data_ctx, f)
+    data_ctx = config.read_context(src_file)
+    logging.debug("Rendering data file: %s to %s" % (src_file, dest_file))
+    with config.output.open(dest_file, 'w') as f:
+        json.dump(dict(data_ctx), f)
     return dest_file
 
-@register('.html')
-def build_html(config, src_file, dest_file):
-    """Builds HTML files from templates
-    
-    TODO: this should be generalized such that other templating engines
-          can be utilized (as the config suggests)
+def page_context(config, src_file):
+    """Returns the context page `src_file` is rendered with: the global
+    context, updated with the page's own
     """
-    src_dir = osp.abspath(config.src_directory)
     base_ctx = config.base_context() or {}
     data_ctx = config.read_context(src_file.replace('.html', '.json'))
     base_ctx.update(data_ctx)
+    return base_ctx
+
+
+def should_stream(config, src_file, dest_file):
+    """Returns True if page `src_file` should be rendered a chunk at a
+    time: it matches one of `stream_pages`, or its last output was at
+    least `stream_threshold` bytes
+    """
+    name = page_name(config, src_file)
+    if any(fnmatch.fnmatch(name, p) for p in config.stream_pages):
+        return True
+    if not config.stream_threshold:
+        return False
+    size = config.output.size(dest_file)
+    return size is not None and size >= config.stream_threshold
+
+
+def current_rss():
+    """Returns the current RSS of this process, in KB, or None where
+    /proc/self/statm isn't available
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE // 1024
+    except (IOError, ValueError, IndexError):
+        return None
+
+
+class RSSSampler(object):
+    """Tracks the highest RSS seen by `sample`, to tell how far
+    rendering a page raises it above where it started. Unlike the
+    process's peak RSS, this is the same for every large page, not just
+    the first one to set a new high.
+    """
+
+    def __init__(self):
+        self.start = self.peak = current_rss()
+
+    def sample(self):
+        rss = current_rss()
+        if rss > self.peak:
+            self.peak = rss
 
-    dest_dir = osp.dirname(dest_file)
+    def grown(self):
+        """Returns the growth in KB, or None if RSS can't be sampled"""
+        if self.start is None:
+            return None
+        return self.peak - self.start
 
-    if not osp.exists(dest_dir):
-        os.makedirs(dest_dir)
 
-    logging.info("Rendering file: %s to %s" % (src_file, dest_file))
+@register('.html')
+@timed()
+def build_html(config, src_file, dest_file):
+    """Builds HTML files from templates. Large pages are streamed to
+    the output, see `should_stream`.
+
+    TODO: this should be generalized such that other templating engines
+          can be utilized (as the config suggests)
+    """
+    context = page_context(config, src_file)
+    stream = should_stream(config, src_file, dest_file)
+
+    logging.debug("Rendering file: %s to %s" % (src_file, dest_file))
+    rss = RSSSampler()
     render_jinja2(env=config.template_env, 
-                  src=src_file[len(src_dir):],
+                  src=page_name(config, src_file),
                   dest=dest_file,
-                  context=base_ctx)
+                  context=context,
+                  output=config.output,
+                  stream=stream,
+                  sample=rss.sample)
+    grown = rss.grown()
+    if grown:
+        logging.debug("Rendering %s raised RSS by %d KB" % \
+                      (src_file, grown))
+    config.record_page(src_file, stream, grown)
 
     return dest_file
 
 
+@timed()
 def build_static(config, src_file, dest_file):
-    """Copies src_file to proper destination.
+    """Copies src_file to proper destination, using the configured
+    `copy_strategy`.
 
-    Handler for files that need not be touched.
+    Handler for files that need not be touched. Nothing is copied if
+    the destination already has the source's size and mtime.
     """
-    # copy the file
-    logging.info("Copying file: %s to %s" % (src_file, dest_file))
-    with open(src_file, 'rb') as src:
-        with open(dest_file, 'wb') as dest:
-            dest.write(src.read())
+    src_st = config.index.stat(src_file)
+    if src_st is None:
+        raise IOError(errno.ENOENT, "No such file", src_file)
+    if config.output.has_copy(src_st, dest_file):
+        logging.debug("Up to date: %s" % dest_file)
+        return dest_file
+
+    logging.debug("Copying file: %s to %s" % (src_file, dest_file))
+    config.output.copy(src_file, dest_file, config.copy_strategy, src_st)
 
     return dest_file
 
 
 @register('.js')
+@timed()
 def build_js(config, src_file, dest_file):
     """Attempts to build javascript, coffee, or iced-coffee-script files.
 
@@ -110,10 +347,10 @@ def build_js(config, src_file, dest_file):
     TODO: make this compile (iced-)coffee files, both files exist and the
     js file is older than the coffee.
     """
-    if not osp.exists(src_file):
+    if not config.index.exists(src_file):
         base, _ = osp.splitext(src_file)
         for ext, func in [('.coffee', build_coffee), ('.iced', build_iced)]:
-            if osp.exists(base + ext):
+            if config.index.exists(base + ext):
                 dbase, _ = osp.splitext(dest_file)
                 return func(config, base + ext, dbase + '.js')
 
@@ -121,6 +358,7 @@ def build_js(config, src_file, dest_file):
 
 
 @register('.css')
+@timed()
 def build_css(config, src_file, dest_file):
     """Attempts to build a css file, or .less to .css should the .css
     be missing.
@@ -131,10 +369,10 @@ def build_css(config, src_file, dest_file):
     TODO: make this compile (iced-)coffee files, both files exist and the
     js file is older than the coffee.
     """
-    if not osp.exists(src_file):
+    if not config.index.exists(src_file):
         base, _ = osp.splitext(src_file)
         for ext, func in [('.less', build_less)]:
-            if osp.exists(base + ext):
+            if config.index.exists(base + ext):
                 dbase, _ = osp.splitext(dest_file)
                 return func(config, base + ext, dbase + '.css')
 
@@ -142,50 +380,62 @@ def build_css(config, src_file, dest_file):
 
 
 @register('.coffee')
+@timed()
 def build_coffee(config, src_file, dest_file):
     base, ext = osp.splitext(dest_file)
     dest_file = base + '.js'
-    logging.info("Building file with coffee: %s to %s" % (src_file, dest_file))
-    output = subprocess.check_output(["coffee", "--print", src_file])
-    with open(dest_file, 'wb') as f:
-        f.write(output)
+    logging.debug("Building file with coffee: %s to %s" % (src_file, dest_file))
+    output = compiler_pool(config).compile('.coffee', src_file)
+    config.output.write(dest_file, output)
     return dest_file
 
 
 @register('.iced')
+@timed()
 def build_iced(config, src_file, dest_file):
     base, ext = osp.splitext(dest_file)
     dest_file = base + '.js'
-    logging.info("Building file with iced: %s to %s" % (src_file, dest_file))
-    output = subprocess.check_output(["iced", "--runtime", "inline",
-                                      "--print", src_file])
-    with open(dest_file, 'wb') as f:
-        f.write(output)
+    logging.debug("Building file with iced: %s to %s" % (src_file, dest_file))
+    output = compiler_pool(config).compile('.iced', src_file)
+    config.output.write(dest_file, output)
     return dest_file
 
 
 @register('.less')
+@timed()
 def build_less(config, src_file, dest_file):
     """Build src_file to dest_file.css using lessc
     """
     base, ext = osp.splitext(dest_file)
     dest_file = base + '.css'
-    logging.info("Building file with lessc: %s to %s" % (src_file, dest_file))
-    subprocess.call(["lessc", src_file, dest_file])
+    logging.debug("Building file with lessc: %s to %s" % (src_file, dest_file))
+    output = compiler_pool(config).compile('.less', src_file)
+    config.output.write(dest_file, output)
 
     return dest_file
 
 
-@evalcontextfilter
-def markdown(ectx, text):
-    result = convert_markdown(text)
-    if ectx.autoescape:
-        result = Markup(result)
-    return result
-
-def render_jinja2(env=None, src=None, dest=None, context=None):
-    env.filters['markdown'] = markdown
+@timed()
+def render_jinja2(env=None, src=None, dest=None, context=None, output=None,
+                  stream=False, sample=None):
+    """Renders template `src` with `context` to `dest`, through the
+    OutputWriter `output` if given. With `stream`, the page is written
+    as it's generated, instead of being built up in memory first.
+    `sample`, if given, is called now and then while rendering, e.g. to
+    sample memory use.
+    """
     tmpl = env.get_template(src)
-    with open(dest, 'w') as f:
-        f.write(tmpl.render(**context))
+    with (output.open(dest, 'w') if output else open(dest, 'w')) as f:
+        if stream:
+            rendered = tmpl.stream(**context)
+            rendered.enable_buffering(STREAM_BUFFER)
+            for i, chunk in enumerate(rendered):
+                f.write(chunk)
+                if sample and i % SAMPLE_EVERY == 0:
+                    sample()
+        else:
+            text = tmpl.render(**context)
+            if sample:
+                sample()
+            f.write(text)
 
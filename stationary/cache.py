@@ -0,0 +1,263 @@
+import errno
+import hashlib
+import logging
+import os
+import os.path as osp
+import re
+import subprocess
+import tempfile
+
+from distutils.spawn import find_executable
+
+from utils import makedirs
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+_COMPILER_VERSIONS = {}
+
+HEX_DIGITS = '0123456789abcdef'
+
+# in the cache directory: compiler path and mtime -> version
+VERSIONS_FILENAME = 'versions.json'
+
+# @import "file", with optional (options) or url(...)
+LESS_IMPORT = re.compile(r'@import\s*(?:\([^)]*\)\s*)?(?:url\(\s*)?'
+                         r'''["']([^"']+)["']''')
+
+
+def compiler_version(cmd, directory=None):
+    """Returns the output of `cmd --version`, which is part of the
+    cache key so that upgrading a compiler invalidates its outputs.
+
+    With `directory`, versions are kept there too, by the path and mtime
+    of the compiler (symlinks resolved), so that the compiler only has
+    to be run again once it's replaced, not by every build.
+    """
+    if cmd in _COMPILER_VERSIONS:
+        return _COMPILER_VERSIONS[cmd]
+
+    path = find_executable(cmd)
+    if path is None:
+        raise OSError(errno.ENOENT, "No such file", cmd)
+    path = osp.realpath(path)
+    st = os.stat(path)
+    binary = '%s:%r:%d' % (path, st.st_mtime, st.st_size)
+
+    versions = {}
+    versions_path = directory and osp.join(directory, VERSIONS_FILENAME)
+    if versions_path:
+        try:
+            with open(versions_path) as f:
+                versions = json.load(f)
+        except (IOError, ValueError):
+            pass
+
+    version = versions.get(binary)
+    if version is None:
+        version = subprocess.check_output([cmd, '--version']).strip()
+        if versions_path:
+            versions[binary] = version
+            makedirs(directory)
+            fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(versions, f, indent=1, sort_keys=True)
+            os.rename(tmp, versions_path)
+    _COMPILER_VERSIONS[cmd] = version
+    return version
+
+
+class CompileCache(object):
+    """Content addressed, on disk cache of compiler outputs.
+
+    Entries are keyed by a hash of the source, compiler, compiler
+    version and flags. Each hit touches the entry's mtime, and once the
+    cache grows past `max_size` bytes the least recently used entries
+    are removed.
+
+    Entries are kept in subdirectories named after the first two hex
+    digits of their key; anything else in `directory`, such as other
+    caches kept beneath it, isn't part of this one.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+
+    def key(self, source, compiler, version, flags):
+        h = hashlib.sha1()
+        for part in [compiler, version] + list(flags):
+            h.update(part)
+            h.update('\0')
+        h.update(source)
+        return h.hexdigest()
+
+    def path(self, key):
+        return osp.join(self.directory, key[:2], key[2:])
+
+    def __contains__(self, key):
+        return osp.exists(self.path(key))
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        path = self.path(key)
+        makedirs(osp.dirname(path))
+        # unique, since other threads and processes may be storing the
+        # same entry
+        fd, tmp = tempfile.mkstemp(dir=osp.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        try:
+            os.rename(tmp, path)
+        except OSError, e:
+            # e.g. the cache was cleared meanwhile; the entry is only lost
+            logging.debug("Can't store %s in the cache: %s" % (path, e))
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            return
+
+        if self._size is None:
+            self._size = self.size()
+        else:
+            self._size += len(data)
+        if self._size > self.max_size:
+            self.evict()
+
+    def entries(self):
+        """Returns (path, stat) for each cache entry"""
+        result = []
+        try:
+            shards = os.listdir(self.directory)
+        except OSError:
+            return result
+        for shard in shards:
+            if len(shard) != 2 or shard.strip(HEX_DIGITS):
+                continue
+            root = osp.join(self.directory, shard)
+            try:
+                files = os.listdir(root)
+            except OSError:
+                continue
+            for f in files:
+                if f.endswith('.tmp'):
+                    # still being stored
+                    continue
+                p = osp.join(root, f)
+                try:
+                    result.append((p, os.stat(p)))
+                except OSError:
+                    pass
+        return result
+
+    def size(self):
+        return sum(st.st_size for _, st in self.entries())
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits in
+        `max_size`
+        """
+        entries = sorted(self.entries(), key=lambda e: e[1].st_mtime)
+        size = sum(st.st_size for _, st in entries)
+        for path, st in entries:
+            if size <= self.max_size:
+                break
+            logging.debug("Evicting %s from compile cache" % path)
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            size -= st.st_size
+        self._size = size
+
+    def clear(self):
+        for path, _ in self.entries():
+            os.unlink(path)
+        self._size = 0
+
+
+def less_imports(src_file):
+    """Returns the files `src_file` @imports, recursively. Like lessc,
+    imports are resolved relative to the importing file, and '.less' is
+    added to names without an extension. Files that don't exist are
+    included, since creating them changes the output.
+    """
+    imports = []
+    stack = [src_file]
+    while stack:
+        path = stack.pop()
+        try:
+            with open(path, 'rb') as f:
+                source = f.read()
+        except IOError:
+            continue
+        for name in LESS_IMPORT.findall(source):
+            if '://' in name:
+                continue
+            if not osp.splitext(name)[1]:
+                name += '.less'
+            imported = osp.normpath(osp.join(osp.dirname(path), name))
+            if imported not in imports and imported != src_file:
+                imports.append(imported)
+                stack.append(imported)
+    return imports
+
+
+def compiler_inputs(cmd, src_file):
+    """Returns the files besides `src_file` that the output of compiler
+    `cmd` run on it depends on
+    """
+    if cmd == 'lessc':
+        return less_imports(src_file)
+    return []
+
+
+def compile_key(cache, argv, src_file):
+    """Returns the cache key for the output of `argv` run on `src_file`,
+    which for lessc covers the files it imports and where it is
+    """
+    with open(src_file, 'rb') as f:
+        source = f.read()
+    flags = list(argv[1:])
+    imports = compiler_inputs(argv[0], src_file)
+    if imports:
+        flags.append(osp.abspath(src_file))
+    for path in imports:
+        try:
+            with open(path, 'rb') as f:
+                digest = hashlib.sha1(f.read()).hexdigest()
+        except IOError:
+            digest = 'missing'
+        flags.append('%s\0%s' % (path, digest))
+    return cache.key(source, argv[0],
+                     compiler_version(argv[0], cache.directory), flags)
+
+
+def run_compiler(cache, argv, src_file):
+    """Returns the output of running `argv` with `src_file` appended,
+    reusing a previous output from `cache` if there is one.
+    """
+    key = compile_key(cache, argv, src_file)
+    output = cache.get(key)
+    if output is None:
+        output = subprocess.check_output(argv + [src_file])
+        cache.put(key, output)
+    return output
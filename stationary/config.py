@@ -1,42 +1,100 @@
 import json
 import logging
+import multiprocessing
 import os
 import subprocess
 
+from collections import MutableMapping
 from ConfigParser import SafeConfigParser as ConfigParser
 from ConfigParser import NoOptionError
 from optparse import OptionParser
 
-from jinja2 import Environment, FileSystemLoader
-
-from utils import reroot
+from assets import asset_url
+from cache import CompileCache, run_compiler
+from index import FileIndex
+from output import OutputWriter
+from timing import timed
+from utils import makedirs, PathMap, COPY_STRATEGIES
 
 pathjoin = os.path.join
 abspath = os.path.abspath
 
 DEFAULT_PROPERTIES = {
     'base_context_filename': '_global.json',
+    'bind_host': 'localhost',
+    'bind_port': 1432,
+    'build_events': ['progress'],
     'build_directory': abspath('build/root/'),
     'build_data_directory': abspath('build/data/'),
+    'cache_directory': abspath('build/cache/'),
+    'cache_size': 100 * 1024 * 1024,
+    'compilers': multiprocessing.cpu_count(),
+    'copy_strategy': 'copy',
     'data_directory': abspath('data/'),
+    'develop_cache_size': 256,
+    'develop_output': 'disk',
+    'fingerprint_assets': False,
     'layout_directory': abspath('layout/'),
     'layout': 'default',
+    'markdown_cache_size': 1024,
+    'markdown_extensions': [],
+    'markdown_persistent_cache': False,
+    'precompress': [],
+    'precompress_min_size': 256,
+    'prune_outputs': True,
+    'server_workers': 8,
     'src_directory': abspath('src/'),
+    'stream_pages': [],
+    'stream_threshold': 1024 * 1024,
     'template_language': 'jinja2',
+    'watch_debounce': 0.2,
+    'watch_interval': 1.0,
 }
 
 make_absolute = lambda x: abspath(str(x))
+comma_list = lambda x: [i.strip() for i in str(x).split(',') if i.strip()]
+boolean = lambda x: str(x).lower() in ('1', 'yes', 'true', 'on')
+
+
+def one_of(*choices):
+    def convert(x):
+        if x not in choices:
+            raise ValueError("'%s' is not one of %s" % (x, ', '.join(choices)))
+        return x
+    return convert
+
 
 # should probably make these do some validation!
 PROPERTY_CONVERTERS = {
     'base_context_filename': str,
+    'bind_host': str,
+    'bind_port': int,
+    'build_events': comma_list,
     'build_directory': make_absolute,
     'build_data_directory': make_absolute,
+    'cache_directory': make_absolute,
+    'cache_size': int,
+    'compilers': int,
+    'copy_strategy': one_of(*COPY_STRATEGIES),
     'data_directory': make_absolute,
+    'develop_cache_size': int,
+    'develop_output': one_of('disk', 'memory'),
+    'fingerprint_assets': boolean,
     'layout_directory': make_absolute,
     'layout': str,
+    'markdown_cache_size': int,
+    'markdown_extensions': comma_list,
+    'markdown_persistent_cache': boolean,
+    'precompress': comma_list,
+    'precompress_min_size': int,
+    'prune_outputs': boolean,
+    'server_workers': int,
     'src_directory': make_absolute,
+    'stream_pages': comma_list,
+    'stream_threshold': int,
     'template_language': str,
+    'watch_debounce': float,
+    'watch_interval': float,
 }
 
 parser = OptionParser()
@@ -44,14 +102,51 @@ parser.add_option('-c', '--config', default=None, dest='config',
                   help="path to config file")
 parser.add_option('-d', '--debug', action='store_true', dest='debug',
                   help="turn on debug output")
+parser.add_option('-f', '--force', action='store_true', dest='force',
+                  default=False,
+                  help="rebuild everything, even if it looks up to date")
+parser.add_option('--profile', action='store_true', dest='profile',
+                  default=False,
+                  help="report where build time is spent")
+parser.add_option('--profile-top', type='int', default=10, dest='profile_top',
+                  help="number of slowest files to report with --profile")
+parser.add_option('--profile-dump', default=None, dest='profile_dump',
+                  help="write --profile timings to this file, as JSON if "
+                       "it ends with .json, otherwise as cProfile stats")
+parser.add_option('--timing', action='store_true', dest='timing',
+                  default=False,
+                  help="report the time spent importing and starting up")
+parser.add_option('--shard', default=None, dest='shard',
+                  help="build only shard I of N (e.g. 2/4) of the source "
+                       "files; see the merge task")
+parser.add_option('-j', '--jobs', type='int', default=1, dest='jobs',
+                  help="number of processes to build with")
+
+# (command, suffix) pairs tried, in order, when looking for a context file
+CONTEXT_PREPROCESSORS = [
+    (None, None),
+    ('coffee', '.coffee'),
+    ('iced', '.iced'),
+    ]
 
 
 # TODO: should make this inherit from dict
 class Config(object):
 
-    def __init__(self, properties=None):
+    def __init__(self, properties=None, options=None):
         self._properties = properties or DEFAULT_PROPERTIES.copy()
         self._template_env = None
+        self._compile_cache = None
+        self._markdown = None
+        self._paths = None
+        self.options = options or parser.get_default_values()
+        self.index = FileIndex()
+        self.context_cache = ContextCache(self)
+        self.output = OutputWriter()
+        self.pages_streamed = 0
+        self.page_peak_rss_max = 0
+        # page -> KB its rendering raised RSS by, until reported
+        self.page_rss = {}
 
     def __getattribute__(self, attr):
         try:
@@ -61,10 +156,18 @@ class Config(object):
                 return self._properties[attr]
             raise e
 
+    @property
+    def paths(self):
+        """The PathMapper for this config's directories"""
+        if not self._paths:
+            self._paths = PathMapper(self)
+        return self._paths
+
+    def base_context_path(self):
+        return pathjoin(self.data_directory, self.base_context_filename)
+
     def base_context(self):
-        base_file = pathjoin(self.data_directory,
-                             self.base_context_filename)
-        return load_context_file(base_file)
+        return ContextView(self.context_cache.load(self.base_context_path()))
         # if os.path.exists(base_file):
         #     if os.access(base_file, os.R_OK):
         #         with open(base_file) as o:
@@ -76,59 +179,231 @@ class Config(object):
 
     @property
     def template_env(self):
+        """The template environment, with FILTERS and the `asset_url`
+        global registered, which keeps compiled templates in
+        `cache_directory`
+        """
         if not self._template_env:
+            # jinja2 and the filters (with markdown) are slow to import, and
+            # many tasks never render anything
+            from jinja2 import (Environment, FileSystemLoader,
+                                FileSystemBytecodeCache)
+            from filters import FILTERS, markdown_filter
+
             loader = FileSystemLoader([pathjoin(self.layout_directory,
                                                 self.layout),
                                        self.src_directory])
-            self._template_env = Environment(loader=loader)
+            bytecode_dir = pathjoin(self.cache_directory, 'templates')
+            makedirs(bytecode_dir)
+            self._template_env = Environment(
+                loader=loader,
+                bytecode_cache=FileSystemBytecodeCache(bytecode_dir))
+            self._template_env.filters.update(FILTERS)
+            self._template_env.filters['markdown'] = markdown_filter(
+                self.markdown)
+            self._template_env.globals['asset_url'] = asset_url(self)
         return self._template_env
 
+    @property
+    def markdown(self):
+        """The MarkdownRenderer used by the `markdown` filter"""
+        if not self._markdown:
+            from filters import MarkdownRenderer
+
+            cache = None
+            if self.markdown_persistent_cache:
+                cache = CompileCache(pathjoin(self.cache_directory, 'markdown'),
+                                     self.cache_size)
+            self._markdown = MarkdownRenderer(self.markdown_extensions,
+                                              self.markdown_cache_size,
+                                              cache)
+        return self._markdown
+
+    @property
+    def compile_cache(self):
+        if not self._compile_cache:
+            self._compile_cache = CompileCache(self.cache_directory,
+                                               self.cache_size)
+        return self._compile_cache
+
     def read_context(self, src_file):
         """Read the context for source file `src_file`
 
         reads the fname as JSON from the data directory if it exists,
         otherwise, {}
         """
-        src_file = abspath(src_file)
         try:
-            data_file = reroot(src_file, 
-                               srcdir=self.src_directory,
-                               destdir=self.data_directory)
-            return load_context_file(data_file)
+            return ContextView(
+                self.context_cache.load(self.context_path(src_file)))
         except ValueError, e:
             logging.warning(str(e))
         except Exception, e:
             logging.error(str(e))
         return {}
 
+    def context_path(self, src_file):
+        """Returns the path of the data context for `src_file`, before
+        any preprocessor suffix is added. Raises ValueError if `src_file`
+        isn't within the source directory.
+        """
+        return self.paths.data(abspath(src_file))
+
+    def stats(self):
+        """Returns counters describing the work done with this config"""
+        return {
+            'context_cache_hits': self.context_cache.hits,
+            'context_cache_misses': self.context_cache.misses,
+            'compile_cache_hits': self.compile_cache.hits,
+            'compile_cache_misses': self.compile_cache.misses,
+            'markdown_cache_hits': self.markdown.hits,
+            'markdown_cache_misses': self.markdown.misses,
+            'outputs_written': self.output.written,
+            'outputs_unchanged': self.output.unchanged,
+            'outputs_removed': self.output.removed,
+            'pages_streamed': self.pages_streamed,
+            'page_peak_rss_max': self.page_peak_rss_max,
+        }
+
+    def record_page(self, src_file, streamed, rss):
+        """Counts a rendered page, and how much rendering it raised the
+        RSS of this process, in KB (None if unknown)
+        """
+        if streamed:
+            self.pages_streamed += 1
+        if rss is not None:
+            self.page_rss[src_file] = rss
+            self.page_peak_rss_max = max(self.page_peak_rss_max, rss)
+
+
+class PathMapper(object):
+    """Maps source files to their build, data and build data paths"""
 
-def load_context_file(path):
-    return find_and_read_context(path) or {}
+    def __init__(self, config):
+        src_dir = abspath(config.src_directory)
+        self.build = PathMap(src_dir, abspath(config.build_directory))
+        self.data = PathMap(src_dir, abspath(config.data_directory))
+        self.build_data = PathMap(src_dir,
+                                  abspath(config.build_data_directory))
+
+
+class ContextCache(object):
+    """Caches parsed context files by path. An entry is reused as long
+    as none of the candidate files for the path (see
+    `context_candidates`) has changed mtime or size, or appeared or
+    disappeared, according to `config.index`.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, path):
+        """Returns the context for `path`. The result is shared, and
+        must not be modified; see `ContextView`.
+        """
+        index = self.config.index
+        key = tuple(_stat_key(index.stat(p)) for p in context_candidates(path))
+        entry = self._entries.get(path)
+        if entry and entry[0] == key:
+            self.hits += 1
+            return entry[1]
 
+        self.misses += 1
+        data = load_context_file(path, self.config.compile_cache, index)
+        self._entries[path] = (key, data)
+        return data
 
-def find_and_read_context(path):
+
+def _stat_key(st):
+    return st and (st.st_mtime, st.st_size)
+
+
+class ContextView(MutableMapping):
+    """Copy-on-write view of a cached context. Reads go to the shared
+    dict; the first write makes a shallow copy, so the cached context
+    is never changed. Nested values are still shared.
+    """
+
+    def __init__(self, data):
+        self._data = data
+        self._owned = False
+
+    def _own(self):
+        if not self._owned:
+            self._data = dict(self._data)
+            self._owned = True
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        self._own()
+        self._data[key] = value
+
+    def __delitem__(self, key):
+        self._own()
+        del self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return 'ContextView(%r)' % (self._data,)
+
+
+def context_candidates(path):
+    """Returns the files that may hold the context for `path`, in the
+    order `find_and_read_context` tries them
+    """
+    return [(path + suffix) if suffix else path
+            for _, suffix in CONTEXT_PREPROCESSORS]
+
+
+def load_context_file(path, compile_cache=None, index=None):
+    return find_and_read_context(path, compile_cache, index) or {}
+
+
+@timed()
+def find_and_read_context(path, compile_cache=None, index=None):
     """Read a context file as a string, potentially with preprocessing
+
+    Preprocessor output is reused from `compile_cache` if given, and
+    candidate files are looked up in `index` if given.
     """
-    preprocessors = [
-        (None, None),
-        ('coffee', '.coffee'),
-        ('iced', '.iced')
-        ]
-    for cmd, suffix in preprocessors:
-        data_file = (path + suffix) if suffix else path
-        if os.path.exists(data_file):
-            if os.access(data_file, os.R_OK):
-                if cmd:
-                    output = subprocess.check_output([cmd, data_file])
-                    return json.loads(output)
-                else:
-                    with open(data_file) as o:
-                        return json.load(o)
+    data_file, cmd = find_context_file(path, index)
+    if data_file:
+        if os.access(data_file, os.R_OK):
+            if cmd and compile_cache:
+                return json.loads(run_compiler(compile_cache, [cmd],
+                                               data_file))
+            elif cmd:
+                output = subprocess.check_output([cmd, data_file])
+                return json.loads(output)
             else:
-                logging.warning("data context '%s' exists, "
-                                "but is not readable." % data_file)
-                return None
-    logging.debug("data context does '%s' does not exist." % data_file)
+                with open(data_file) as o:
+                    return json.load(o)
+        else:
+            logging.warning("data context '%s' exists, "
+                            "but is not readable." % data_file)
+            return None
+    logging.debug("data context does '%s' does not exist." % path)
+
+
+def find_context_file(path, index=None):
+    """Returns (file, preprocessor command) for the first of the
+    candidate context files for `path` that exists, or (None, None)
+    """
+    exists = index.exists if index else os.path.exists
+    for cmd, suffix in CONTEXT_PREPROCESSORS:
+        data_file = (path + suffix) if suffix else path
+        if exists(data_file):
+            return data_file, cmd
+    return None, None
 
 
 def read_config(fname=None):
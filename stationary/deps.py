@@ -0,0 +1,222 @@
+import logging
+import os
+import os.path as osp
+
+from index import FileIndex
+from utils import parse_shard, shard_filename
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+DEPS_FILENAME = '.stationary-deps.json'
+DEPS_VERSION = 1
+
+
+def deps_path(config):
+    """Returns the path of the dependency graph for `config`; each shard of a
+    sharded build has its own
+    """
+    name = DEPS_FILENAME
+    shard = parse_shard(config.options.shard)
+    if shard:
+        name = shard_filename(name, shard)
+    return osp.join(osp.abspath(config.build_directory), name)
+
+
+def page_name(config, src_file):
+    """Returns the template name `src_file` is rendered under, the same
+    name `Environment.list_templates` gives it
+    """
+    return src_file[len(osp.abspath(config.src_directory)):].lstrip('/')
+
+
+class DependencyGraph(object):
+    """Which templates extend, include or import which, as found in
+    their Jinja2 ASTs, and which pages end up using each template.
+
+    Each template's references are cached along with its filename and
+    mtime, and only parsed again when the mtime changes, or when the
+    name no longer resolves to that file through the loader's search
+    path, e.g. after the layout changed. Templates are stat'ed through
+    `index`.
+    """
+
+    def __init__(self, env, path=None, templates=None, pages=None):
+        self.env = env
+        self.path = path
+        self.index = FileIndex()
+        # template name -> {'filename': ..., 'mtime': ..., 'refs': [...]}
+        self.templates = templates or {}
+        # page src file -> filenames of every template it uses
+        self.pages = pages or {}
+        self._dependents = None
+        self._updated_templates = set()
+        self._updated_pages = set()
+
+    @classmethod
+    def load(cls, env, path):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return cls(env, path)
+        if data.get('version') != DEPS_VERSION:
+            return cls(env, path)
+        return cls(env, path, templates=data.get('templates'),
+                   pages=data.get('pages'))
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'version': DEPS_VERSION,
+                       'templates': self.templates,
+                       'pages': self.pages}, f)
+        os.rename(tmp, self.path)
+
+    def clear(self):
+        """Forgets every template and page"""
+        self.templates = {}
+        self.pages = {}
+        self._dependents = None
+
+    def _candidates(self, name):
+        """Returns the paths the loader looks for template `name` at, in
+        order, or None if it doesn't load from a search path
+        """
+        searchpath = getattr(self.env.loader, 'searchpath', None)
+        if searchpath is None:
+            return None
+        return [osp.join(d, *name.split('/')) for d in searchpath]
+
+    def _shadows(self, name, filename):
+        """Returns the paths earlier in the search path than `filename`,
+        where a new template `name` would take its place
+        """
+        shadows = []
+        for path in self._candidates(name) or ():
+            if path == filename:
+                break
+            shadows.append(path)
+        return shadows
+
+    def _resolves_to(self, name, filename):
+        """Returns True if the loader would still load template `name`
+        from `filename`
+        """
+        candidates = self._candidates(name)
+        if candidates is None:
+            return True
+        for path in candidates:
+            if self.index.exists(path):
+                return path == filename
+        return False
+
+    def _template(self, name):
+        """Returns the cache entry for template `name`, or None if it
+        can't be found
+        """
+        entry = self.templates.get(name)
+        if entry:
+            st = self.index.stat(entry['filename'])
+            if (st and st.st_mtime == entry['mtime'] and
+                self._resolves_to(name, entry['filename'])):
+                return entry
+
+        from jinja2 import TemplateNotFound, meta
+
+        try:
+            source, filename, _ = self.env.loader.get_source(self.env, name)
+        except TemplateNotFound:
+            self.templates.pop(name, None)
+            return None
+
+        # dynamic references (e.g. {% extends var %}) show up as None
+        refs = [r for r in meta.find_referenced_templates(self.env.parse(source))
+                if r]
+        entry = self.templates[name] = {
+            'filename': filename,
+            'mtime': self.index.stat(filename).st_mtime,
+            'refs': refs,
+        }
+        self._updated_templates.add(name)
+        return entry
+
+    def templates_of(self, name):
+        """Returns the filenames of template `name` and of every template
+        it references, recursively, along with the paths where a new
+        template would shadow one of them (see `_shadows`), so that
+        creating one counts as a change
+        """
+        seen = set()
+        stack = [name]
+        files = []
+        while stack:
+            n = stack.pop()
+            if n in seen:
+                continue
+            seen.add(n)
+            entry = self._template(n)
+            if entry:
+                files.extend(self._shadows(n, entry['filename']))
+                files.append(entry['filename'])
+                stack.extend(entry['refs'])
+        return files
+
+    def add_page(self, src_file, name):
+        """Records the templates used by the page `src_file`, rendered as
+        template `name`, and returns their filenames
+        """
+        files = self.templates_of(name)
+        if self.pages.get(src_file) != files:
+            self.pages[src_file] = files
+            self._dependents = None
+            self._updated_pages.add(src_file)
+        return files
+
+    def remove_page(self, src_file):
+        if self.pages.pop(src_file, None) is not None:
+            self._dependents = None
+
+    def take_updates(self):
+        """Returns (templates, pages) entries changed since the last
+        call, for `merge` to apply to another process's graph
+        """
+        templates = dict((n, self.templates[n])
+                         for n in self._updated_templates
+                         if n in self.templates)
+        pages = dict((p, self.pages[p])
+                     for p in self._updated_pages if p in self.pages)
+        self._updated_templates = set()
+        self._updated_pages = set()
+        return templates, pages
+
+    def merge(self, templates, pages):
+        self.templates.update(templates)
+        self.pages.update(pages)
+        self._dependents = None
+
+    def dependents(self, filename):
+        """Returns the pages that use the template file `filename`"""
+        if self._dependents is None:
+            self._dependents = {}
+            for page, files in self.pages.iteritems():
+                for f in files:
+                    self._dependents.setdefault(f, set()).add(page)
+        return sorted(self._dependents.get(filename, ()))
+
+
+def dependency_graph(config):
+    """Returns the DependencyGraph for `config`, loading it from the
+    build directory the first time
+    """
+    graph = getattr(config, '_dependency_graph', None)
+    if graph is None:
+        graph = config._dependency_graph = DependencyGraph.load(
+            config.template_env, deps_path(config))
+        logging.debug("Loaded dependencies of %d templates" % \
+                      len(graph.templates))
+    graph.index = config.index
+    return graph
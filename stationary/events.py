@@ -0,0 +1,251 @@
+import logging
+import os
+import os.path as osp
+import time
+
+from plugins import SINKS_GROUP, load_plugin
+from utils import makedirs
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+STARTED = 'started'
+FINISHED = 'finished'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+
+class Sink(object):
+    """Receives build events. Each event is a dict with at least
+    'event' (one of STARTED, FINISHED, SKIPPED, FAILED), 'source' (the
+    source file's path), 'type' (its extension) and 'time'; finished
+    and failed events also have 'duration', in seconds, and finished
+    ones 'bytes' and 'outputs', and for pages, 'rss': how many KB
+    rendering raised the RSS of the process that built it, where that
+    can be measured.
+
+    `expect` is told how many more sources are about to be built or
+    skipped, and `flush` is called at the end of every build.
+    """
+
+    def expect(self, count):
+        pass
+
+    def handle(self, event):
+        pass
+
+    def flush(self):
+        pass
+
+
+class ProgressSink(Sink):
+    """Logs a line of progress at most every `interval` seconds, and
+    once more at the end of the build
+    """
+
+    def __init__(self, interval=None):
+        self.interval = float(interval or 2.0)
+        self._reset()
+
+    def _reset(self):
+        self.total = 0
+        self.counts = dict.fromkeys((FINISHED, SKIPPED, FAILED), 0)
+        self._logged = None
+        self._unlogged = False
+
+    def expect(self, count):
+        if self._logged is None:
+            self._logged = time.time()
+        self.total += count
+
+    def handle(self, event):
+        if event['event'] not in self.counts:
+            return
+        self.counts[event['event']] += 1
+        self._unlogged = True
+        if time.time() - (self._logged or 0) >= self.interval:
+            self._log()
+
+    def _log(self):
+        c = self.counts
+        logging.info("Progress: %d/%d file(s), %d built, %d skipped, "
+                     "%d failed" % (sum(c.values()), self.total,
+                                    c[FINISHED], c[SKIPPED], c[FAILED]))
+        self._logged = time.time()
+        self._unlogged = False
+
+    def flush(self):
+        if self._unlogged:
+            self._log()
+        self._reset()
+
+
+class JsonLinesSink(Sink):
+    """Appends each event to the file at `path`, as a line of JSON"""
+
+    def __init__(self, path=None):
+        if not path:
+            raise ValueError("jsonl needs a file, e.g. jsonl:events.jsonl")
+        self.path = osp.abspath(path)
+        self._file = None
+
+    def handle(self, event):
+        if self._file is None:
+            makedirs(osp.dirname(self.path))
+            self._file = open(self.path, 'a')
+        self._file.write(json.dumps(event, sort_keys=True) + '\n')
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+
+class Totals(Sink):
+    """Counts events by type of source: how many of each, and the
+    seconds spent and bytes written building them
+    """
+
+    def __init__(self):
+        # type -> {event: count, 'seconds': s, 'bytes': n}
+        self.types = {}
+
+    def handle(self, event):
+        totals = self.types.setdefault(event['type'], {
+                STARTED: 0, FINISHED: 0, SKIPPED: 0, FAILED: 0,
+                'seconds': 0.0, 'bytes': 0})
+        totals[event['event']] += 1
+        totals['seconds'] += event.get('duration', 0.0)
+        totals['bytes'] += event.get('bytes', 0)
+
+
+class SummarySink(Totals):
+    """Logs a table of the build's totals by type of source"""
+
+    def flush(self):
+        if not self.types:
+            return
+        logging.info("  %-10s %8s %8s %8s %12s %9s" % \
+                     ('type', 'built', 'skipped', 'failed', 'bytes',
+                      'seconds'))
+        for t, totals in sorted(self.types.iteritems()):
+            logging.info("  %-10s %8d %8d %8d %12d %9.3f" % \
+                         (t or '(none)', totals[FINISHED], totals[SKIPPED],
+                          totals[FAILED], totals['bytes'], totals['seconds']))
+        self.types = {}
+
+
+class PrometheusSink(Totals):
+    """Writes counters for every build since the process started to
+    `path`, in the Prometheus text format, e.g. for node_exporter's
+    textfile collector. The file is replaced atomically at the end of
+    each build.
+    """
+
+    def __init__(self, path=None):
+        Totals.__init__(self)
+        if not path:
+            raise ValueError("prometheus needs a file, "
+                             "e.g. prometheus:stationary.prom")
+        self.path = osp.abspath(path)
+
+    def flush(self):
+        lines = [
+            '# HELP stationary_files_total Source files, by event.',
+            '# TYPE stationary_files_total counter',
+        ]
+        for t, totals in sorted(self.types.iteritems()):
+            for event in (STARTED, FINISHED, SKIPPED, FAILED):
+                lines.append('stationary_files_total{event="%s",type="%s"} %d'
+                             % (event, t, totals[event]))
+        for name, key, text in [
+                ('stationary_build_seconds_total', 'seconds',
+                 'Time spent building source files.'),
+                ('stationary_output_bytes_total', 'bytes',
+                 'Bytes of output built.')]:
+            lines.append('# HELP %s %s' % (name, text))
+            lines.append('# TYPE %s counter' % name)
+            for t, totals in sorted(self.types.iteritems()):
+                lines.append('%s{type="%s"} %s' % (name, t, totals[key]))
+        lines.append('# HELP stationary_last_build_timestamp_seconds '
+                     'When the last build finished.')
+        lines.append('# TYPE stationary_last_build_timestamp_seconds gauge')
+        lines.append('stationary_last_build_timestamp_seconds %.3f' % \
+                     time.time())
+
+        makedirs(osp.dirname(self.path))
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(tmp, self.path)
+
+
+# name -> sink class, each taking the text after the colon in
+# 'name:argument', if any
+SINKS = {
+    'jsonl': JsonLinesSink,
+    'progress': ProgressSink,
+    'prometheus': PrometheusSink,
+    'summary': SummarySink,
+}
+
+
+def make_sink(spec):
+    """Returns the sink described by `spec`, 'name' or 'name:argument',
+    or None if it can't be made. Sinks not in SINKS are looked for among
+    the `stationary.event_sinks` entry points.
+    """
+    name, _, arg = spec.partition(':')
+    factory = SINKS.get(name) or load_plugin(SINKS_GROUP, name)
+    if factory is None:
+        logging.warning("Unknown build event sink '%s'" % name)
+        return None
+    try:
+        return factory(arg) if arg else factory()
+    except ValueError, e:
+        logging.warning("Can't use build event sink '%s': %s" % (spec, e))
+        return None
+
+
+class BuildEvents(object):
+    """Hands events about each source file built to `sinks`. With no
+    sinks, emitting an event costs next to nothing.
+    """
+
+    def __init__(self, sinks=None):
+        self.sinks = sinks or []
+
+    def expect(self, count):
+        for sink in self.sinks:
+            sink.expect(count)
+
+    def emit(self, event, src_file, when=None, **fields):
+        """Hands an `event` about `src_file` to the sinks; `fields`
+        that are None are left out
+        """
+        if not self.sinks:
+            return
+        fields = dict((k, v) for k, v in fields.iteritems() if v is not None)
+        fields['event'] = event
+        fields['source'] = src_file
+        fields['type'] = osp.splitext(src_file)[1]
+        fields['time'] = when or time.time()
+        for sink in self.sinks:
+            sink.handle(fields)
+
+    def flush(self):
+        for sink in self.sinks:
+            sink.flush()
+
+
+def build_events(config):
+    """Returns the BuildEvents for `config`, with the sinks listed in
+    `build_events`
+    """
+    events = getattr(config, '_build_events', None)
+    if events is None:
+        events = config._build_events = BuildEvents(
+            filter(None, [make_sink(s) for s in config.build_events]))
+    return events
@@ -0,0 +1,75 @@
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+from jinja2 import evalcontextfilter, Markup
+from markdown import markdown as convert_markdown
+
+
+class MarkdownRenderer(object):
+    """Converts Markdown with `extensions`, remembering the `size` most
+    recently used results, and, if given a CompileCache as `cache`,
+    keeping every result there too.
+
+    Results are keyed by a hash of the text and the extensions.
+    """
+
+    def __init__(self, extensions=(), size=1024, cache=None):
+        self.extensions = list(extensions)
+        self.size = size
+        self.cache = cache
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, text):
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        h = hashlib.sha1(','.join(self.extensions))
+        h.update('\0')
+        h.update(text)
+        return h.hexdigest()
+
+    def convert(self, text):
+        key = self.key(text)
+        with self._lock:
+            result = self._results.pop(key, None)
+            if result is not None:
+                self._results[key] = result
+                self.hits += 1
+                return result
+
+        stored = self.cache and self.cache.get(key)
+        if stored is not None:
+            result = stored.decode('utf-8')
+            self.hits += 1
+        else:
+            result = convert_markdown(text, extensions=self.extensions)
+            self.misses += 1
+            if self.cache:
+                self.cache.put(key, result.encode('utf-8'))
+
+        with self._lock:
+            self._results[key] = result
+            while len(self._results) > self.size:
+                self._results.popitem(last=False)
+        return result
+
+
+def markdown_filter(renderer):
+    """Returns a `markdown` filter that converts with `renderer`"""
+    @evalcontextfilter
+    def markdown(ectx, text):
+        result = renderer.convert(text)
+        if ectx.autoescape:
+            result = Markup(result)
+        return result
+    return markdown
+
+
+# filters registered with every template environment, besides `markdown`,
+# which is made for each one with `markdown_filter`
+FILTERS = {
+}
@@ -0,0 +1,98 @@
+import os
+import os.path as osp
+import stat
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+class FileIndex(object):
+    """Answers questions about files by asking the filesystem every time.
+    This is what a Config uses when nothing has been scanned, e.g. in the
+    develop server.
+    """
+
+    def stat(self, path):
+        """Returns the stat of `path`, or None if it doesn't exist"""
+        try:
+            return os.stat(path)
+        except OSError:
+            return None
+
+    def exists(self, path):
+        return self.stat(path) is not None
+
+    def invalidate(self, path):
+        pass
+
+
+class TreeIndex(FileIndex):
+    """In-memory index of every file under `roots`, with its stat, built
+    in one pass over the tree (with scandir, if available).
+
+    Paths outside the roots are looked up on the filesystem. Changes to
+    files under the roots aren't noticed unless they're passed to
+    `invalidate`.
+    """
+
+    def __init__(self, roots):
+        self.roots = [osp.abspath(r) for r in roots]
+        self._prefixes = tuple(r.rstrip(os.sep) + os.sep for r in self.roots)
+        self._stats = {}
+        for root in self.roots:
+            if osp.isdir(root):
+                self._scan(root)
+
+    def _scan(self, directory):
+        # like os.walk, symlinks to files are followed, but symlinks to
+        # directories aren't
+        if scandir:
+            for entry in scandir(directory):
+                if entry.is_dir(follow_symlinks=False):
+                    self._scan(entry.path)
+                elif entry.is_file():
+                    self._stats[entry.path] = entry.stat()
+        else:
+            for name in os.listdir(directory):
+                path = osp.join(directory, name)
+                try:
+                    st = os.lstat(path)
+                except OSError:
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    self._scan(path)
+                    continue
+                if stat.S_ISLNK(st.st_mode):
+                    st = FileIndex.stat(self, path)
+                if st is not None and stat.S_ISREG(st.st_mode):
+                    self._stats[path] = st
+
+    def covers(self, path):
+        return path.startswith(self._prefixes)
+
+    def stat(self, path):
+        if self.covers(path):
+            return self._stats.get(path)
+        return FileIndex.stat(self, path)
+
+    def files(self, root):
+        """Returns the indexed files under `root`, sorted"""
+        prefix = osp.abspath(root).rstrip(os.sep) + os.sep
+        return sorted(p for p in self._stats if p.startswith(prefix))
+
+    def invalidate(self, path):
+        """Updates the entry for `path` after it was created, changed
+        or removed
+        """
+        if not self.covers(path):
+            return
+        st = FileIndex.stat(self, path)
+        if st is not None and stat.S_ISREG(st.st_mode):
+            self._stats[path] = st
+        else:
+            self._stats.pop(path, None)
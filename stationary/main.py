@@ -1,8 +1,17 @@
+import time
+
+# before anything else is imported, for --timing
+START = time.time()
+
+import cProfile
 import logging
 import sys
 
 from stationary.config import read_config, parser
-from stationary.action import TASKS
+from stationary.action import TASKS, find_task
+from stationary import timing
+
+IMPORTED = time.time()
 
 def main():
     """Do the right thing.
@@ -10,6 +19,7 @@ def main():
     tasks = []
     options, args = parser.parse_args()
     config = read_config(options.config)
+    config.options = options
 
     level = logging.INFO
     if options.debug:
@@ -20,19 +30,44 @@ def main():
             break
         elif arg == 'help':
             # check for help on the *next* argument
-            if (i+1) < len(pargs):
-                TASKS['help']['command'](config, pargs[i+1])
+            if (i+1) < len(args):
+                TASKS['help']['command'](config, args[i+1])
             else:
                 TASKS['help']['command'](config)
             raise SystemExit()
-        elif arg in TASKS:
-            tasks.append(TASKS[arg])
+        elif find_task(arg):
+            tasks.append((find_task(arg), []))
+        elif tasks:
+            # anything else is an argument to the preceding task
+            tasks[-1][1].append(arg)
 
     logging.basicConfig(format='%(levelname)s: %(msg)s', 
                         level=level)
 
+    if options.profile:
+        timing.enable()
+
+    # anything but JSON is dumped as cProfile stats, of this process only
+    profile = None
+    if options.profile_dump and not options.profile_dump.endswith('.json'):
+        profile = cProfile.Profile()
+        profile.enable()
+
+    started = time.time()
     if not tasks:
         TASKS['help']['command'](config)
     else:
-        for task in sorted(tasks, key=lambda x: x['priority']):
-            task['command'](config)
+        for task, task_args in sorted(tasks, key=lambda x: x[0]['priority']):
+            task['command'](config, *task_args)
+
+    if profile:
+        profile.disable()
+        profile.dump_stats(options.profile_dump)
+
+    if options.timing:
+        done = time.time()
+        logging.info("Imports: %.1fms, startup: %.1fms, tasks: %.1fms, "
+                     "total: %.1fms (%d modules loaded)" % \
+                     ((IMPORTED - START) * 1000, (started - IMPORTED) * 1000,
+                      (done - started) * 1000, (done - START) * 1000,
+                      len([m for m in sys.modules.values() if m])))
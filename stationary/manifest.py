@@ -0,0 +1,208 @@
+import hashlib
+import logging
+import os
+import os.path as osp
+
+from assets import assets_path
+from cache import compiler_inputs
+from config import context_candidates
+from deps import dependency_graph, page_name
+from index import FileIndex
+from utils import parse_shard, shard_filename
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+MANIFEST_FILENAME = '.stationary-manifest.json'
+MANIFEST_VERSION = 1
+
+# properties that change what sources build to; a build with any of them
+# changed rebuilds everything
+SETTINGS_PROPERTIES = (
+    'base_context_filename',
+    'data_directory',
+    'fingerprint_assets',
+    'layout',
+    'layout_directory',
+    'markdown_extensions',
+    'precompress',
+    'src_directory',
+)
+
+# sources that may stand in for a missing file, see `build_js` and `build_css`
+SIBLING_SOURCES = {
+    '.js': ('.coffee', '.iced'),
+    '.css': ('.less',),
+}
+
+
+def manifest_path(config, sharded=True):
+    """Returns the path of the build manifest for `config`; each shard of a
+    sharded build has its own, unless `sharded` is False
+    """
+    name = MANIFEST_FILENAME
+    shard = parse_shard(config.options.shard)
+    if shard and sharded:
+        name = shard_filename(name, shard)
+    return osp.join(osp.abspath(config.build_directory), name)
+
+
+def settings_digest(config):
+    """Returns a hash of the SETTINGS_PROPERTIES of `config`"""
+    settings = [getattr(config, p) for p in SETTINGS_PROPERTIES]
+    return hashlib.sha1(json.dumps(settings, sort_keys=True)).hexdigest()
+
+
+def file_digest(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), ''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_inputs(config, src_file):
+    """Returns every path whose contents determine the outputs built
+    from `src_file`. Paths that don't exist are included, so that they
+    trigger a rebuild once they're created.
+    """
+    inputs = [src_file]
+    base, ext = osp.splitext(src_file)
+    inputs.extend(base + e for e in SIBLING_SOURCES.get(ext, ()))
+    for path in list(inputs):
+        if path.endswith('.less') and config.index.exists(path):
+            inputs.extend(compiler_inputs('lessc', path))
+
+    if ext == '.html':
+        inputs.extend(context_candidates(config.base_context_path()))
+        try:
+            inputs.extend(context_candidates(
+                    config.context_path(base + '.json')))
+        except ValueError:
+            pass
+        inputs.extend(dependency_graph(config).add_page(
+                src_file, page_name(config, src_file)))
+        if config.fingerprint_assets:
+            # any asset_url may have changed
+            inputs.append(assets_path(config))
+    return inputs
+
+
+class Manifest(object):
+    """Records the inputs and outputs of each source file built, so
+    that later builds can skip sources whose inputs haven't changed.
+
+    Inputs are compared by mtime and size first, falling back to a
+    content hash if either differs. They're stat'ed through `index`,
+    which can be set to a TreeIndex to avoid asking the filesystem.
+    Outputs are looked for with `output_exists`, which can be set to
+    look elsewhere, e.g. in a MemoryOutput.
+
+    `extra` lists the files the build wrote that no one source did,
+    such as fingerprinted and precompressed copies, so that they can be
+    removed once they're no longer made. `settings` is the
+    `settings_digest` of the config the entries were built with.
+    """
+
+    def __init__(self, path, entries=None, extra=None, settings=None):
+        self.path = path
+        self.entries = entries or {}
+        self.extra = extra or []
+        self.settings = settings
+        self.index = FileIndex()
+        self.output_exists = osp.exists
+        self._signatures = {}
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (IOError, ValueError), e:
+            if osp.exists(path):
+                logging.warning("Ignoring unreadable build manifest %s: %s" % \
+                                (path, e))
+            return cls(path)
+
+        if data.get('version') != MANIFEST_VERSION:
+            logging.info("Build manifest %s is out of date, ignoring" % path)
+            return cls(path)
+        return cls(path, entries=data.get('entries'),
+                   extra=data.get('extra'), settings=data.get('settings'))
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'version': MANIFEST_VERSION,
+                       'entries': self.entries,
+                       'extra': self.extra,
+                       'settings': self.settings}, f)
+        os.rename(tmp, self.path)
+
+    def signature(self, path):
+        """Returns [mtime, size, sha1] for `path`, or None if it
+        doesn't exist.
+        """
+        st = self.index.stat(path)
+        if st is None:
+            return None
+
+        sig = self._signatures.get(path)
+        if not sig or sig[0] != st.st_mtime or sig[1] != st.st_size:
+            sig = [st.st_mtime, st.st_size, file_digest(path)]
+            self._signatures[path] = sig
+        return sig
+
+    def _unchanged(self, path, recorded):
+        st = self.index.stat(path)
+        if recorded is None or st is None:
+            return recorded is None and st is None
+        if recorded[0] == st.st_mtime and recorded[1] == st.st_size:
+            return True
+        sig = self.signature(path)
+        if sig[2] == recorded[2]:
+            # same content, remember the new mtime so we don't hash it again
+            recorded[0], recorded[1] = sig[0], sig[1]
+            return True
+        return False
+
+    def is_fresh(self, key):
+        """Returns True if `key` was built before, all of its outputs
+        still exist and none of its inputs have changed since.
+        """
+        entry = self.entries.get(key)
+        if not entry:
+            return False
+        if not all(self.output_exists(o) for o in entry['outputs']):
+            return False
+        return all(self._unchanged(p, s)
+                   for p, s in entry['inputs'].iteritems())
+
+    def outputs(self):
+        """Returns the set of every output recorded"""
+        return set(o for entry in self.entries.itervalues()
+                   for o in entry['outputs'])
+
+    def written(self):
+        """Returns the set of every file the build is known to have
+        written: the outputs recorded, and `extra`
+        """
+        return self.outputs().union(self.extra)
+
+    def retain(self, keys):
+        """Drops the entries whose key isn't in `keys`, and returns the
+        keys dropped
+        """
+        dropped = [k for k in self.entries if k not in keys]
+        for k in dropped:
+            del self.entries[k]
+        return dropped
+
+    def record(self, key, inputs, outputs):
+        self.entries[key] = {
+            'inputs': dict((p, self.signature(p)) for p in inputs),
+            'outputs': list(outputs),
+        }
@@ -0,0 +1,210 @@
+import errno
+import os
+import os.path as osp
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from cStringIO import StringIO
+
+from utils import copy_file, is_copy_of, makedirs, same_contents
+
+# mkstemp creates files only the owner can read; outputs get the usual mode
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+class OutputWriter(object):
+    """Publishes build outputs atomically and only when they change.
+
+    Each output is written to a temporary file beside its destination,
+    compared with the existing file, and renamed over it only if the
+    contents differ, so readers never see a partial file and unchanged
+    outputs keep their mtime. Directories are created as needed.
+    Counts files written, unchanged and removed.
+    """
+
+    def __init__(self):
+        self.written = 0
+        self.unchanged = 0
+        self.removed = 0
+        self._lock = threading.Lock()
+        self._dirs = set()
+
+    def _count(self, attr):
+        with self._lock:
+            setattr(self, attr, getattr(self, attr) + 1)
+
+    def ensure_dir(self, path):
+        """Creates directory `path` unless it's already known to exist"""
+        if path not in self._dirs:
+            makedirs(path)
+            self._dirs.add(path)
+
+    def forget_dirs(self):
+        """Forgets which directories exist, e.g. after removing them"""
+        self._dirs = set()
+
+    def has_copy(self, src_st, dest):
+        """Returns True if `dest` already looks like a copy of the file
+        `src_st` was stat'ed from, see `is_copy_of`
+        """
+        return is_copy_of(src_st, dest)
+
+    def size(self, dest):
+        """Returns the size of `dest` as last published, or None"""
+        try:
+            return os.stat(dest).st_size
+        except OSError:
+            return None
+
+    def _temp(self, dest):
+        directory = osp.dirname(dest)
+        self.ensure_dir(directory)
+        try:
+            return self._mkstemp(dest)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            # removed since we made it, e.g. by `clean` in another shell
+            self._dirs.discard(directory)
+            self.ensure_dir(directory)
+            return self._mkstemp(dest)
+
+    def _mkstemp(self, dest):
+        return tempfile.mkstemp(dir=osp.dirname(dest),
+                                prefix='.%s.' % osp.basename(dest),
+                                suffix='.tmp')
+
+    @contextmanager
+    def open(self, dest, mode='wb'):
+        """Returns a file to write `dest`'s contents to; they're
+        published when the `with` block exits without an error
+        """
+        fd, tmp = self._temp(dest)
+        f = os.fdopen(fd, mode)
+        try:
+            yield f
+            f.close()
+            self.publish(tmp, dest)
+        except:
+            f.close()
+            if osp.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def write(self, dest, data):
+        with self.open(dest) as f:
+            f.write(data)
+
+    def copy(self, src, dest, strategy='copy', src_st=None):
+        """Copies `src` to `dest` with `copy_file`"""
+        src_st = src_st or os.stat(src)
+        fd, tmp = self._temp(dest)
+        os.close(fd)
+        try:
+            copy_file(src, tmp, strategy, src_st)
+            if not self.publish(tmp, dest):
+                # keep the mtime in step with src, so the copy is skipped
+                # next time
+                os.utime(dest, (src_st.st_atime, src_st.st_mtime))
+        except:
+            if osp.lexists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def publish(self, tmp, dest):
+        """Renames `tmp` over `dest` if their contents differ, otherwise
+        removes `tmp`. Returns True if `dest` was replaced.
+        """
+        if same_contents(tmp, dest):
+            os.unlink(tmp)
+            self._count('unchanged')
+            return False
+        if os.stat(tmp).st_nlink == 1:
+            os.chmod(tmp, 0666 & ~_UMASK)
+        os.rename(tmp, dest)
+        self._count('written')
+        return True
+
+    def remove(self, path):
+        os.unlink(path)
+        self._count('removed')
+
+
+
+# an output kept in memory: its contents, or the path of a file with
+# the same contents, and when it was made
+MemoryFile = namedtuple('MemoryFile', 'data path mtime')
+
+
+class MemoryOutput(object):
+    """Keeps outputs in memory instead of writing them, with the same
+    interface as OutputWriter, for a develop server that shouldn't
+    touch the build directory.
+
+    Only the `size` most recently used outputs are kept. Copies aren't
+    made at all; the output refers to the source file instead.
+    """
+
+    def __init__(self, size):
+        self.max_files = size
+        self.written = 0
+        self.unchanged = 0
+        self.removed = 0
+        # last known size of each output, kept after it's evicted
+        self.sizes = {}
+        self._lock = threading.Lock()
+        self._files = OrderedDict()
+
+    def __contains__(self, dest):
+        return dest in self._files
+
+    def get(self, dest):
+        """Returns the MemoryFile for `dest`, or None"""
+        with self._lock:
+            f = self._files.pop(dest, None)
+            if f is not None:
+                self._files[dest] = f
+            return f
+
+    def _put(self, dest, f):
+        with self._lock:
+            self._files.pop(dest, None)
+            self._files[dest] = f
+            if f.data is not None:
+                self.sizes[dest] = len(f.data)
+            self.written += 1
+            while len(self._files) > self.max_files:
+                self._files.popitem(last=False)
+
+    def ensure_dir(self, path):
+        pass
+
+    def forget_dirs(self):
+        pass
+
+    def has_copy(self, src_st, dest):
+        return False
+
+    def size(self, dest):
+        return self.sizes.get(dest)
+
+    @contextmanager
+    def open(self, dest, mode='wb'):
+        buf = StringIO()
+        yield buf
+        self._put(dest, MemoryFile(buf.getvalue(), None, time.time()))
+
+    def write(self, dest, data):
+        self._put(dest, MemoryFile(data, None, time.time()))
+
+    def copy(self, src, dest, strategy='copy', src_st=None):
+        self._put(dest, MemoryFile(None, src, time.time()))
+
+    def remove(self, path):
+        with self._lock:
+            if self._files.pop(path, None) is not None:
+                self.removed += 1
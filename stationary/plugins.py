@@ -0,0 +1,41 @@
+import logging
+
+BUILDERS_GROUP = 'stationary.builders'
+TASKS_GROUP = 'stationary.tasks'
+SINKS_GROUP = 'stationary.event_sinks'
+
+# group -> {name: EntryPoint}
+_entry_points = {}
+
+
+def entry_points(group):
+    """Returns the entry points other packages provide in `group`, by
+    name. pkg_resources, which is slow to import, is only imported the
+    first time plugins are looked for.
+    """
+    eps = _entry_points.get(group)
+    if eps is None:
+        try:
+            import pkg_resources
+        except ImportError:
+            eps = {}
+        else:
+            eps = dict((ep.name, ep)
+                       for ep in pkg_resources.iter_entry_points(group))
+        _entry_points[group] = eps
+    return eps
+
+
+def load_plugin(group, name):
+    """Imports and returns what the entry point `name` in `group` refers
+    to, or None if there's no such entry point or it can't be loaded
+    """
+    ep = entry_points(group).get(name)
+    if ep is None:
+        return None
+    try:
+        return ep.load()
+    except Exception, e:
+        logging.warning("Can't load plugin %s from %s: %s" % \
+                        (name, ep.module_name, e))
+        return None
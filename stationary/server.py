@@ -0,0 +1,295 @@
+import BaseHTTPServer
+import Queue
+import errno
+import os
+import os.path as osp
+import shutil
+import sys
+import threading
+import traceback
+import zlib
+
+from email.utils import parsedate_tz, mktime_tz
+
+from assets import ENCODINGS, asset_map, is_current
+from build import STREAM_BUFFER, build_file, page_context, should_stream
+from deps import page_name
+from manifest import Manifest, manifest_path, file_inputs
+from output import MemoryOutput
+from utils import mimeof
+
+
+SEND_CHUNK_SIZE = 64 * 1024
+
+
+def accepted_encodings(header):
+    """Returns the set of content codings an Accept-Encoding header
+    allows
+    """
+    encodings = set()
+    for item in (header or '').split(','):
+        params = [p.strip() for p in item.split(';')]
+        q = 1.0
+        for p in params[1:]:
+            if p.startswith('q='):
+                try:
+                    q = float(p[2:])
+                except ValueError:
+                    q = 0.0
+        if params[0] and q > 0:
+            encodings.add(params[0].lower())
+    return encodings
+
+
+class InFlight(object):
+    """Runs at most one call per key at a time. Callers asking for a key
+    that's already running wait for that call and share its result.
+    """
+
+    class Call(object):
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def run(self, key, func, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self.Call()
+
+        if leader:
+            try:
+                call.result = func(*args)
+            except:
+                call.error = sys.exc_info()
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        else:
+            call.done.wait()
+
+        if call.error:
+            raise call.error[0], call.error[1], call.error[2]
+        return call.result
+
+
+class PooledHTTPServer(BaseHTTPServer.HTTPServer):
+    """HTTPServer that handles requests on a fixed number of threads"""
+
+    def __init__(self, server_address, handler_class, workers):
+        BaseHTTPServer.HTTPServer.__init__(self, server_address, handler_class)
+        self._requests = Queue.Queue()
+        for i in range(workers):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+    def _work(self):
+        while True:
+            request, client_address = self._requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+
+def make_handler(config):
+    in_memory = config.develop_output == 'memory'
+    # the dev server's record of what it has built; it's never saved, since
+    # it doesn't build data files the way `build` does
+    if in_memory:
+        # outputs are kept in an LRU instead of the build directory
+        config.output = MemoryOutput(config.develop_cache_size)
+        manifest = Manifest(manifest_path(config))
+        manifest.output_exists = config.output.__contains__
+    else:
+        manifest = Manifest.load(manifest_path(config))
+    in_flight = InFlight()
+
+    def build_if_stale(src_file, dest_file):
+        """Returns the output to serve for `src_file`: its path, or its
+        MemoryFile when outputs are kept in memory
+        """
+        if manifest.is_fresh(src_file):
+            dest_file = manifest.entries[src_file]['outputs'][0]
+        else:
+            dest_file = build_file(config, src_file, dest_file)
+            manifest.record(src_file, file_inputs(config, src_file),
+                            [dest_file])
+        if not in_memory:
+            return dest_file
+
+        f = config.output.get(dest_file)
+        if f is None:
+            # evicted since it was checked
+            f = config.output.get(build_file(config, src_file, dest_file))
+        return f
+
+    class BuildHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+        def do_HEAD(s):
+            s.send_response(200)
+            s.send_header("Content-type", "text/html")
+            s.end_headers()
+    
+        def do_GET(self):
+            """Build/cache and serve a page"""
+            src_dir = osp.abspath(config.src_directory)
+
+            try:
+                if self.path == '/':
+                    self.path = '/index.html'
+
+                src_file = osp.join(src_dir, self.path[1:])
+                if config.fingerprint_assets and not osp.exists(src_file):
+                    # a fingerprinted copy serves what its asset is now
+                    asset = asset_map(config).source(self.path[1:])
+                    if asset:
+                        src_file = osp.join(src_dir, asset)
+                dest_file = config.paths.build(src_file)
+
+                # don't even check if file exists, raise an error if it doesn't
+                try:
+                    # concurrent requests for a file share one build
+                    if (in_memory and src_file.endswith('.html') and
+                        should_stream(config, src_file, dest_file)):
+                        self.send_stream(src_file, dest_file)
+                        return
+                    output = in_flight.run(src_file, build_if_stale,
+                                           src_file, dest_file)
+                    if not in_memory:
+                        self.send_file(output)
+                    elif output.path:
+                        self.send_file(output.path)
+                    else:
+                        self.send_data(self.path, output.data, output.mtime)
+                except (IOError, OSError), e:
+                    if isinstance(e, OSError) and e.errno != errno.ENOENT:
+                        raise
+                    self.send_response(404)
+                    self.send_header('Content-Type', 'text/plain')
+                    self.end_headers()
+                    self.wfile.write("404 Not found")
+            except:
+                self.send_response(500)
+                self.send_header('Content-Type', 'text/plain')
+                self.end_headers()
+                traceback.print_exc(file=self.wfile)
+
+        def send_file(self, path):
+            """Streams `path`, or answers 304 if the client's copy, as
+            described by If-None-Match or If-Modified-Since, is current.
+            An up to date precompressed copy is sent instead if the
+            client accepts its encoding.
+            """
+            encoding = self.precompressed(path)
+            if encoding:
+                f = open(path + ENCODINGS[encoding], 'rb')
+            else:
+                f = open(path, 'rb')
+            try:
+                st = os.fstat(f.fileno())
+                etag = '"%x-%x"' % (int(st.st_mtime), st.st_size)
+
+                if self.not_modified(etag, st.st_mtime):
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+
+                self.send_response(200)
+                self.send_header('Content-Type', mimeof(path))
+                if encoding:
+                    self.send_header('Content-Encoding', encoding)
+                if config.precompress:
+                    self.send_header('Vary', 'Accept-Encoding')
+                self.send_header('Content-Length', str(st.st_size))
+                self.send_header('ETag', etag)
+                self.send_header('Last-Modified',
+                                 self.date_time_string(st.st_mtime))
+                self.end_headers()
+                shutil.copyfileobj(f, self.wfile, SEND_CHUNK_SIZE)
+            finally:
+                f.close()
+
+        def send_data(self, path, data, mtime):
+            """Sends `data`, the contents of the file at URL `path`, or
+            answers 304 if the client's copy is current
+            """
+            etag = '"%x-%x"' % (zlib.crc32(data) & 0xffffffff, len(data))
+            if self.not_modified(etag, mtime):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', mimeof(path))
+            self.send_header('Content-Length', str(len(data)))
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', self.date_time_string(mtime))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def send_stream(self, src_file, dest_file):
+            """Renders page `src_file` straight into the response, a
+            chunk at a time
+            """
+            tmpl = config.template_env.get_template(
+                page_name(config, src_file))
+            stream = tmpl.stream(**page_context(config, src_file))
+            stream.enable_buffering(STREAM_BUFFER)
+            # errors in the first chunk can still be answered properly
+            chunks = iter(stream)
+            first = next(chunks, u'')
+
+            self.send_response(200)
+            self.send_header('Content-Type', mimeof(self.path))
+            self.end_headers()
+            self.wfile.write(first)
+            size = len(first)
+            for chunk in chunks:
+                self.wfile.write(chunk)
+                size += len(chunk)
+            config.output.sizes[dest_file] = size
+
+        def precompressed(self, path):
+            """Returns the encoding, of those the client accepts, of an
+            up to date precompressed copy of `path`, or None
+            """
+            accepted = accepted_encodings(
+                self.headers.getheader('Accept-Encoding'))
+            if not accepted:
+                return None
+            st = os.stat(path)
+            for encoding in ('br', 'gzip'):
+                if (encoding in accepted and
+                    is_current(path + ENCODINGS[encoding], st)):
+                    return encoding
+            return None
+
+        def not_modified(self, etag, mtime):
+            if_none_match = self.headers.getheader('If-None-Match')
+            if if_none_match:
+                tags = [t.strip() for t in if_none_match.split(',')]
+                return etag in tags or '*' in tags
+
+            if_modified_since = self.headers.getheader('If-Modified-Since')
+            if if_modified_since:
+                since = parsedate_tz(if_modified_since)
+                return since is not None and int(mtime) <= mktime_tz(since)
+            return False
+
+    return BuildHandler
@@ -0,0 +1,97 @@
+import json
+import logging
+import time
+
+from functools import wraps
+
+
+# the active Profiler, or None when profiling is off
+_profiler = None
+
+
+class Profiler(object):
+    """Accumulates time spent per phase (builder, context loading,
+    rendering...) and per source file
+    """
+
+    def __init__(self):
+        # phase -> [calls, seconds]
+        self.phases = {}
+        # src file -> seconds
+        self.files = {}
+
+    def add(self, phase, seconds, src_file=None):
+        totals = self.phases.setdefault(phase, [0, 0.0])
+        totals[0] += 1
+        totals[1] += seconds
+        if src_file:
+            self.files[src_file] = self.files.get(src_file, 0.0) + seconds
+
+    def take(self):
+        """Returns (phases, files) recorded so far, and starts over"""
+        data = (self.phases, self.files)
+        self.phases, self.files = {}, {}
+        return data
+
+    def merge(self, phases, files):
+        for phase, (calls, seconds) in phases.iteritems():
+            totals = self.phases.setdefault(phase, [0, 0.0])
+            totals[0] += calls
+            totals[1] += seconds
+        for src_file, seconds in files.iteritems():
+            self.files[src_file] = self.files.get(src_file, 0.0) + seconds
+
+    def report(self, top=10):
+        if self.files:
+            logging.info("Slowest files:")
+            slowest = sorted(self.files.iteritems(), key=lambda f: -f[1])
+            for src_file, seconds in slowest[:top]:
+                logging.info("  %8.3fs  %s" % (seconds, src_file))
+        if self.phases:
+            logging.info("Time per phase:")
+            for phase, (calls, seconds) in sorted(self.phases.iteritems(),
+                                                  key=lambda p: -p[1][1]):
+                logging.info("  %8.3fs  %6d calls  %s" % \
+                             (seconds, calls, phase))
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump({'phases': self.phases, 'files': self.files}, f,
+                      indent=2)
+
+
+def enable():
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler()
+    return _profiler
+
+
+def profiler():
+    """Returns the active Profiler, or None"""
+    return _profiler
+
+
+def timed(phase=None, per_file=False):
+    """Decorator that, while profiling is enabled, records the time
+    spent in the function under `phase` (default: the function's name).
+    With `per_file`, the time is also added to the source file passed as
+    the second argument, as in `build_file(config, src_file, ...)`.
+
+    When profiling is off, the only cost is checking whether it's on.
+    """
+    def decorator(func):
+        name = phase or func.__name__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return func(*args, **kwargs)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _profiler.add(name, time.time() - start,
+                              args[1] if per_file else None)
+        return wrapper
+    return decorator
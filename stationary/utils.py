@@ -1,8 +1,21 @@
+import errno
+import fcntl
 import os
+import shutil
+import zlib
 
 abspath = os.path.abspath
 pathjoin = os.path.join
 
+COPY_CHUNK_SIZE = 1024 * 1024
+COPY_STRATEGIES = ('copy', 'sendfile', 'reflink', 'hardlink')
+
+# from linux/fs.h
+FICLONE = 0x40049409
+
+# imported by `mimeof`, the first time it's needed
+mimetypes = None
+
 
 def allf(fns, a):
     """Calls all `fns` with `a` and returns True if
@@ -11,6 +24,19 @@ def allf(fns, a):
     return all([fn(a) for fn in fns])
 
 
+def mimeof(path):
+    global mimetypes
+    if mimetypes is None:
+        import mimetypes
+        mimetypes.add_type('.coffee', 'text/x-coffeescript')
+        mimetypes.add_type('.iced', 'text/x-iced-coffeescript')
+        mimetypes.add_type('.less', 'text/css')
+    t, _ = mimetypes.guess_type(path)
+    if t:
+        return t
+    return 'application/octet-stream'
+
+
 def reroot(name, srcdir=None, destdir=None):
     """Reroots the path `name` with a base directory
     relative to `srcdir` into `destdir`
@@ -33,3 +59,141 @@ def reroot(name, srcdir=None, destdir=None):
                              (name, srcdir))
 
     return pathjoin(destdir, os.path.sep.join(reversed(namebits)))
+
+
+class PathMap(object):
+    """Maps paths under `srcdir` to the same relative path under
+    `destdir`, like `reroot`, but by slicing off the prefix. Paths that
+    don't start with `srcdir` are handed to `reroot`, so it behaves
+    the same for them, ValueError included.
+    """
+
+    def __init__(self, srcdir, destdir):
+        self.srcdir = srcdir
+        self.destdir = destdir
+        self._prefix = srcdir.rstrip(os.path.sep) + os.path.sep
+
+    def __call__(self, name):
+        if name.startswith(self._prefix):
+            return pathjoin(self.destdir, name[len(self._prefix):])
+        return reroot(name, srcdir=self.srcdir, destdir=self.destdir)
+
+
+def makedirs(path):
+    """Creates `path` and any missing parents. Unlike `os.makedirs`,
+    it's not an error if another process creates them first.
+    """
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+
+def is_copy_of(src_st, dest):
+    """Returns True if `dest` looks like a copy of the file `src_st` was
+    stat'ed from, judging by size and mtime
+    """
+    try:
+        dest_st = os.stat(dest)
+    except OSError:
+        return False
+    return (dest_st.st_size == src_st.st_size and
+            int(dest_st.st_mtime) == int(src_st.st_mtime))
+
+
+def same_contents(a, b):
+    """Returns True if files `a` and `b` both exist and have the same
+    contents. Sizes are compared first, so most differing files are
+    never read.
+    """
+    try:
+        if os.stat(a).st_size != os.stat(b).st_size:
+            return False
+    except OSError:
+        return False
+    with open(a, 'rb') as fa:
+        with open(b, 'rb') as fb:
+            while True:
+                chunk = fa.read(COPY_CHUNK_SIZE)
+                if chunk != fb.read(COPY_CHUNK_SIZE):
+                    return False
+                if not chunk:
+                    return True
+
+
+def copy_file(src, dest, strategy='copy', src_st=None):
+    """Copies `src` to `dest`, keeping its mtime.
+
+    `strategy` is one of COPY_STRATEGIES; 'hardlink' and 'reflink' share
+    the data with `src` where the filesystem allows it and 'sendfile'
+    copies within the kernel where Python supports it. All of them fall
+    back to 'copy', a chunked copy. `src_st` saves stat'ing `src` if
+    the caller already has.
+    """
+    st = src_st or os.stat(src)
+    if strategy == 'hardlink':
+        try:
+            if os.path.lexists(dest):
+                os.unlink(dest)
+            os.link(src, dest)
+            return
+        except OSError:
+            pass
+
+    with open(src, 'rb') as s:
+        with open(dest, 'wb') as d:
+            if strategy == 'reflink':
+                try:
+                    fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+                    strategy = None
+                except IOError:
+                    pass
+            elif strategy == 'sendfile' and hasattr(os, 'sendfile'):
+                offset = 0
+                while offset < st.st_size:
+                    sent = os.sendfile(d.fileno(), s.fileno(), offset,
+                                       COPY_CHUNK_SIZE)
+                    if not sent:
+                        break
+                    offset += sent
+                strategy = None
+
+            if strategy:
+                shutil.copyfileobj(s, d, COPY_CHUNK_SIZE)
+    os.utime(dest, (st.st_atime, st.st_mtime))
+
+
+def parse_shard(value):
+    """Parses a shard given as 'I/N' into (I, N), or returns None if
+    `value` is empty. Raises ValueError unless 1 <= I <= N.
+    """
+    if not value:
+        return None
+    try:
+        i, n = [int(x) for x in value.split('/')]
+    except ValueError:
+        raise ValueError("shard (%s) should look like I/N" % value)
+    if not 1 <= i <= n:
+        raise ValueError("shard (%s) should have 1 <= I <= N" % value)
+    return i, n
+
+
+def in_shard(relpath, shard):
+    """Returns True if the file at `relpath` belongs to `shard`, an
+    (I, N) pair. Files are assigned by a hash of their path, so every
+    machine agrees.
+    """
+    i, n = shard
+    return (zlib.crc32(relpath) & 0xffffffff) % n == i - 1
+
+
+def shard_filename(filename, shard):
+    """Returns `filename` with the shard worked in before its extension,
+    e.g. '.stationary-manifest.2-of-4.json'; with `shard` None, a glob
+    matching any shard's file
+    """
+    base, ext = os.path.splitext(filename)
+    if shard is None:
+        return '%s.*-of-*%s' % (base, ext)
+    return '%s.%d-of-%d%s' % (base, shard[0], shard[1], ext)
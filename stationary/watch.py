@@ -0,0 +1,109 @@
+import os
+import os.path as osp
+import time
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+
+class PollingWatcher(object):
+    """Finds changed files by comparing the mtime and size of every file
+    under `roots` every `interval` seconds
+    """
+
+    def __init__(self, roots, interval=1.0):
+        self.roots = roots
+        self.interval = interval
+        self._snapshot = self.snapshot()
+
+    def snapshot(self):
+        files = {}
+        for root in self.roots:
+            for dirpath, dirs, names in os.walk(root):
+                for name in names:
+                    path = osp.join(dirpath, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    files[path] = (st.st_mtime, st.st_size)
+        return files
+
+    def poll(self, timeout):
+        """Returns the paths created, changed or removed within
+        `timeout` seconds, or None to wait until something changes
+        """
+        deadline = timeout is not None and time.time() + timeout
+        while True:
+            wait = self.interval
+            if deadline:
+                wait = min(wait, max(deadline - time.time(), 0))
+            time.sleep(wait)
+
+            current = self.snapshot()
+            previous, self._snapshot = self._snapshot, current
+            changed = set(p for p in set(current) | set(previous)
+                          if current.get(p) != previous.get(p))
+            if changed or (deadline and time.time() >= deadline):
+                return changed
+
+
+class InotifyWatcher(object):
+    """Finds changed files with inotify, through pyinotify"""
+
+    def __init__(self, roots):
+        self.roots = roots
+        self._changed = set()
+        self._manager = pyinotify.WatchManager()
+        mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE |
+                pyinotify.IN_DELETE | pyinotify.IN_MODIFY |
+                pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO |
+                pyinotify.IN_ATTRIB)
+        for root in roots:
+            self._manager.add_watch(root, mask, rec=True, auto_add=True)
+        self._notifier = pyinotify.Notifier(self._manager, self._event)
+
+    def _event(self, event):
+        if not event.dir:
+            self._changed.add(event.pathname)
+
+    def poll(self, timeout):
+        """Returns the paths created, changed or removed within
+        `timeout` seconds, or None to wait until something changes
+        """
+        ms = None if timeout is None else int(timeout * 1000)
+        if self._notifier.check_events(ms):
+            self._notifier.read_events()
+            self._notifier.process_events()
+        changed, self._changed = self._changed, set()
+        return changed
+
+    def close(self):
+        self._notifier.stop()
+
+
+def make_watcher(roots, interval=1.0):
+    """Returns an InotifyWatcher if pyinotify is available, otherwise a
+    PollingWatcher
+    """
+    roots = [r for r in roots if osp.isdir(r)]
+    if pyinotify:
+        return InotifyWatcher(roots)
+    return PollingWatcher(roots, interval)
+
+
+def wait_for_changes(watcher, debounce):
+    """Blocks until something changes, then keeps collecting changes
+    until none have happened for `debounce` seconds. Returns the set of
+    changed paths.
+    """
+    changed = set()
+    while not changed:
+        changed |= watcher.poll(None)
+    while True:
+        more = watcher.poll(debounce)
+        if not more:
+            return changed
+        changed |= more
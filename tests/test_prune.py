@@ -0,0 +1,73 @@
+import logging
+import os
+import os.path as osp
+import shutil
+import tempfile
+import unittest
+
+from stationary import action
+from stationary.config import Config, DEFAULT_PROPERTIES
+
+
+def write(path, data):
+    if not osp.isdir(osp.dirname(path)):
+        os.makedirs(osp.dirname(path))
+    with open(path, 'w') as f:
+        f.write(data)
+
+
+class PruneOutputsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.build_dir = osp.join(self.root, 'build')
+        write(osp.join(self.root, 'src', 'index.html'), 'index')
+        write(osp.join(self.root, 'src', 'old', 'page.txt'), 'old')
+        os.makedirs(osp.join(self.root, 'data'))
+        os.makedirs(osp.join(self.root, 'layout', 'default'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def build(self, root=None):
+        root = root or self.root
+        properties = DEFAULT_PROPERTIES.copy()
+        for name in ('src', 'data', 'layout', 'build'):
+            properties[name + '_directory'] = osp.join(root, name)
+        properties['build_data_directory'] = osp.join(root, 'build', 'data')
+        properties['cache_directory'] = osp.join(root, 'cache')
+        properties['build_events'] = []
+        action.build(Config(properties=properties))
+
+    def test_untracked_files_survive(self):
+        self.build()
+        write(osp.join(self.build_dir, '.git', 'config'), '[core]')
+        write(osp.join(self.build_dir, 'CNAME'), 'example.com')
+        self.build()
+        self.assertTrue(osp.exists(osp.join(self.build_dir, '.git', 'config')))
+        self.assertTrue(osp.exists(osp.join(self.build_dir, 'CNAME')))
+
+    def test_orphaned_outputs_are_removed(self):
+        self.build()
+        self.assertTrue(osp.exists(osp.join(self.build_dir, 'old',
+                                            'page.txt')))
+        shutil.rmtree(osp.join(self.root, 'src', 'old'))
+        self.build()
+        self.assertFalse(osp.exists(osp.join(self.build_dir, 'old')))
+        self.assertTrue(osp.exists(osp.join(self.build_dir, 'index.html')))
+
+    def test_outputs_of_another_checkout_survive(self):
+        self.build()
+        copy = osp.join(self.root, 'copy')
+        for name in ('src', 'data', 'layout', 'build'):
+            shutil.copytree(osp.join(self.root, name), osp.join(copy, name))
+        self.build(copy)
+        self.assertTrue(osp.exists(osp.join(self.build_dir, 'index.html')))
+        self.assertTrue(osp.exists(osp.join(self.build_dir, 'old',
+                                            'page.txt')))
+        self.assertTrue(osp.exists(osp.join(copy, 'build', 'index.html')))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    unittest.main()